@@ -3,24 +3,38 @@ Small app for displaying 3D shapes
 """
 from functools import partial
 from math import pi, cos
-import numpy as np
 from time import time
-import asyncio
-from collections import deque
+import os
 
 import toga
 from . import toga_fixes
 from toga.style import Pack
 from toga.style.pack import COLUMN, ROW, CENTER, BOTTOM
 from toga.colors import rgb
+from toga.fonts import MONOSPACE
 from travertino.size import at_least
 
-from . import transforms as tr
 from . import models
+from . import importers
+from . import renderer
+from .profiler import FrameProfiler
+from .scene import Scene
+from .worker import FrameWorker
+from .scheduler import AnimationScheduler
 
 class Shapes(toga.App):
     home_z_rotation = pi / 8
     home_x_rotation = pi / 4.5
+    animation_fps = 30
+    # Have the canvas draw frames straight from their arrays rather than
+    # through its drawing object tree
+    direct_draw = True
+    # Shape kinds by the names they have in `shape_select`
+    shape_kinds = {
+        'Cylinder': 'cylinder',
+        'Cone': 'cone',
+        'Duble Cone': 'duble_cone',
+    }
 
     def startup(self):
         """
@@ -30,13 +44,35 @@ class Shapes(toga.App):
         We then create a main window (with a name matching the app), and
         show the main window.
         """
+        self._meshes = models.MeshCache(cache_dir=self.paths.cache / 'meshes')
         self._draw_color = rgb(0, 0, 128)
-        self._draw_shape = models.box()
+        self._draw_shape = self._meshes.get('cylinder', 4)
+        # Shapes loaded from files, by the name they have in `shape_select`
+        self._imported = dict()
+        self._scene = Scene()
+        self._scene_object = \
+            self._scene.add(self._draw_shape, self._draw_color)
         self._z_rotation = self.home_z_rotation
         self._x_rotation = self.home_x_rotation
         self._z_speed = 0
         self._x_speed = 0
         self._animating = False
+        self._frame_worker = FrameWorker(self.prepare_frame)
+        self._next_frame = None
+        self._frame_seq = 0
+        self._shown_frame_seq = 0
+        self._scheduler = AnimationScheduler(
+            self.animation_frame, fps=self.animation_fps
+        )
+        self._scheduler.start(self._impl.loop)
+        self._profiler = FrameProfiler()
+        self._show_profile = False
+        self._render_requested = False
+        self._last_frame_key = None
+        self._last_frame_shape = None
+        # Set SHAPES_TRACE to a .json or .csv file path to get a per-frame
+        # timing trace written whenever an animation stops
+        self._trace_path = os.environ.get('SHAPES_TRACE')
 
         self.canvas = toga_fixes.Canvas(
             style=Pack(flex=1),
@@ -44,6 +80,9 @@ class Shapes(toga.App):
         )
         self.canvas.intrinsic = \
             Pack.IntrinsicSize(width=at_least(50), height=at_least(50))
+        self._canvas_target = renderer.RetainedCanvasTarget(
+            self.canvas, overlay_font=toga.Font(family=MONOSPACE, size=9)
+        )
 
         self.main_box = toga.Box(style=Pack(direction=ROW), children=[
             self.canvas,
@@ -88,7 +127,7 @@ class Shapes(toga.App):
 
     def make_shapes_box(self):
         self.shape_select = toga.Selection(
-            items=['Cylinder', 'Cone', 'Duble Cone'],
+            items=list(self.shape_kinds),
             style=Pack(width=132),
             on_select = self.set_draw_shape,
         )
@@ -102,6 +141,10 @@ class Shapes(toga.App):
             children=[
                 self.shape_select,
                 self.shape_segments,
+                toga.Button(
+                    'Load...', on_press=self.load_shape,
+                    style=Pack(width=132),
+                ),
             ],
         )
 
@@ -116,7 +159,7 @@ class Shapes(toga.App):
         ]
         buttons = [
             toga.Button(
-                symbol, on_press=async_partial(self.motion, direction=direction),
+                symbol, on_press=partial(self.motion, direction=direction),
                 style=Pack(width=width, height=46)
             )
             for direction, symbol, width in motions
@@ -138,28 +181,33 @@ class Shapes(toga.App):
         self._polygons_display = toga.Label('0 Polygons', style=Pack(
             text_align=CENTER, width=132, height=30
         ))
+        profile_switch = toga.Switch(
+            'Profiler', on_toggle=self.toggle_profile,
+            style=Pack(width=132, height=30)
+        )
         return toga.Box(
             style=Pack(direction=COLUMN, alignment=BOTTOM, flex=1),
             children=[
                 toga.Box(style=Pack(flex=1)),
+                profile_switch,
                 self._polygons_display,
                 self._fps_display,
             ],
         )
 
-    async def motion(self, widget, direction):
+    def motion(self, widget, direction):
         if direction == 'home':
             self._z_rotation = self.home_z_rotation
             self._x_rotation = self.home_x_rotation
             self._x_speed = 0
             self._z_speed = 0
-            self._animating = False
-            self.render()
+            self.stop_animation()
+            self.request_render()
             return
         elif direction == 'stop':
             self._x_speed = 0
             self._z_speed = 0
-            self._animating = False
+            self.stop_animation()
             return
         elif direction == 'up':
             self._x_speed = min(self._x_speed + pi/72, pi)
@@ -170,87 +218,189 @@ class Shapes(toga.App):
         elif direction == 'right':
             self._z_speed = max(self._z_speed - pi/72, -pi)
         if self._x_speed == 0 and self._z_speed == 0:
-            self._animating = False
+            self.stop_animation()
             return
         self._start_x_rot = self._x_rotation
         self._start_z_rot = self._z_rotation
         self._start_time = time()
-        if self._animating:
+        if not self._animating:
+            self._animating = True
+            self._fps_time = time()
+            self._fps_cnt = 0
+        # Even when already animating, as the scheduler goes idle if a frame
+        # fails
+        self._scheduler.wake()
+
+    def stop_animation(self):
+        if not self._animating:
             return
-        self._animating = True
-        fps_time = time()
-        fps_cnt = 0
-        while self._animating:
-            time_passed = time() - self._start_time
-            self._x_rotation = (self._start_x_rot + self._x_speed * time_passed) % (2 * pi)
-            self._z_rotation = (self._start_z_rot + self._z_speed * time_passed) % (2 * pi)
-            self.render()
-            await self.canvas.draw_done()
-            fps_cnt += 1
-            now = time()
-            if now - fps_time >= 1.:
-                self._fps_display.text = '{:.2f} FPS'.format(fps_cnt/(now - fps_time))
-                fps_time = now
-                fps_cnt = 0
+        self._animating = False
         print('animation stopped')
+        if self._trace_path:
+            self._profiler.dump(self._trace_path)
+            print('frame trace written to {}'.format(self._trace_path))
+
+    async def animation_frame(self):
+        """Render an animation frame, called by the animation scheduler
+
+        Returns False to let the scheduler idle when there is nothing to
+        animate.
+        """
+        if not self._animating:
+            return False
+        if self._next_frame is None:
+            self._next_frame = self.submit_frame()
+        # Taken before awaiting it, so a frame that failed is not awaited
+        # again after the scheduler recovers
+        next_frame, self._next_frame = self._next_frame, None
+        prepared = await next_frame
+        if not self._animating:
+            # Stopped while the frame was being prepared, so what is shown
+            # is behind the current rotation
+            self._last_frame_key = None
+            self.request_render()
+            return False
+        # Start preparing the next frame while this one gets drawn
+        self._next_frame = self.submit_frame()
+        if prepared is not None:
+            seq, frame, record = prepared
+            if self.present(seq, frame, record):
+                with record.stage('gtk_draw'):
+                    await self.canvas.draw_done()
+                self._fps_cnt += 1
+        now = time()
+        if now - self._fps_time >= 1.:
+            self._fps_display.text = '{:.2f} FPS'.format(
+                self._fps_cnt/(now - self._fps_time)
+            )
+            self._fps_time = now
+            self._fps_cnt = 0
+        return True
 
     def set_draw_color(self, widget, color):
         self._draw_color = color
-        self.render()
+        self._scene_object.color = color
+        self.request_render()
 
     def render_event(self, widget):
+        # Called from within the GTK draw callback, so the canvas must be
+        # updated right away rather than on the next event loop iteration
         self.render()
 
-    def world_model(self):
-        rotations = tr.rotate_z(self._z_rotation) @ tr.rotate_x(self._x_rotation)
-        world_transform = rotations @ tr.move(0, 5)
-
-        vertices = self._draw_shape.vertices
-        vertices = vertices @ world_transform
+    def toggle_profile(self, widget):
+        self._show_profile = widget.is_on
+        self.request_render()
 
-        normals = self._draw_shape.normals
-        normals = normals @ rotations
-        normals = normals[:,:3]
+    def request_render(self):
+        """Render on the next event loop iteration
 
-        faces = self._draw_shape.faces
-        face_indices = np.arange(len(faces))
-        faces, normals, face_indices, backface_indices = \
-            tr.backface_culling(faces, normals, face_indices)
+        Requests made before that happens are coalesced into a single
+        render.
+        """
+        if self._render_requested:
+            return
+        self._render_requested = True
+        self._impl.loop.call_soon(self._requested_render)
 
-        edges = tr.backface_edge_culling(self._draw_shape.edges, backface_indices)
+    def _requested_render(self):
+        self._render_requested = False
+        self.render()
 
-        light_vector = np.array([1., 1., -1.], dtype=np.float32)
+    def frame_key(self):
+        """Get a key identifying everything the rendered frame depends on"""
+        return (
+            self._x_rotation,
+            self._z_rotation,
+            id(self._draw_shape),
+            (self._draw_color.r, self._draw_color.g, self._draw_color.b),
+            self.canvas.layout.content_width,
+            self.canvas.layout.content_height,
+            self._show_profile,
+        )
 
-        light_cos = np.inner(normals, light_vector) / \
-            (np.linalg.norm(normals, axis=1) * np.linalg.norm(light_vector))
-        colors = np.array([color_ramp(self._draw_color, c) for c in light_cos])
+    def submit_frame(self):
+        """Start preparing the current animation frame in the background
 
-        return vertices, faces, edges, colors, face_indices, backface_indices
+        Returns an asyncio future of a (sequence number, frame, profiler
+        record) tuple, or of None if the frame would be the same as the last
+        one.
+        """
+        time_passed = time() - self._start_time
+        self._x_rotation = (self._start_x_rot + self._x_speed * time_passed) % (2 * pi)
+        self._z_rotation = (self._start_z_rot + self._z_speed * time_passed) % (2 * pi)
+        args = self._frame_args()
+        loop = self._impl.loop
+        if args is None:
+            future = loop.create_future()
+            future.set_result(None)
+            return future
+        seq, record, args = args
+        future = self._frame_worker.submit(loop, record, *args)
+        return loop.create_task(self._numbered(seq, record, future))
+
+    async def _numbered(self, seq, record, future):
+        return seq, await future, record
 
     def render(self):
-        cw = self.canvas.layout.content_width
-        ch = self.canvas.layout.content_height
+        """Render the current frame onto the canvas
 
-        vertices, faces, edges, colors, face_indices, backface_indices = \
-            self.world_model()
+        Returns False without drawing anything if the frame would be the same
+        as the last one rendered.
+        """
+        args = self._frame_args()
+        if args is None:
+            return False
+        seq, record, args = args
+        return self.present(
+            seq, self._frame_worker.prepare(record, *args), record
+        )
 
-        vertices = tr.perspective(vertices, 2)
-        screen_transform = tr.scale(cw/2, cw/2, -cw/2) @ tr.move(cw/2, 0, ch/2)
-        vertices = vertices @ screen_transform
+    def _frame_args(self):
+        """Get a sequence number, a profiler record and the arguments to
+        prepare the current frame with, or None if it would be the same as the
+        last one"""
+        frame_key = self.frame_key()
+        if frame_key == self._last_frame_key:
+            return None
+        self._last_frame_key = frame_key
+        # Keep the shape alive so its id in the frame key is not reused
+        self._last_frame_shape = self._draw_shape
+        self._frame_seq += 1
+        record = self._profiler.begin_frame()
+        # The worker gets a copy of the scene, so changes made to it while
+        # frames are in flight only show in the frames requested after them
+        return self._frame_seq, record, (
+            self._scene.snapshot(), self._x_rotation, self._z_rotation,
+            self.canvas.layout.content_width,
+            self.canvas.layout.content_height,
+        )
 
-        self.canvas.clear()
-        with self.canvas.fill(color='white') as fill:
-            fill.rect(x=0, y=0, width=cw, height=ch)
+    def prepare_frame(
+        self, pipeline, arena, record, scene, x_rotation, z_rotation, w, h
+    ):
+        """Prepare a frame of a scene snapshot, called on the frame worker
+        thread"""
+        pipeline.update(x_rotation, z_rotation, w, h)
+        shapes = scene.select_levels(pipeline)
+        return renderer.prepare_scene(scene, pipeline, record, arena, shapes)
 
-        # Flip normals because we flipped the Z axis in screen transform
-        normals = -tr.normals(vertices, faces)
-        faces, normals, face_indices, backface_indices, colors = \
-            tr.backface_culling(faces, normals, face_indices, backface_indices, colors)
-        self.render_faces(vertices, faces, colors)
+    def present(self, seq, frame, record):
+        """Draw a prepared frame onto the canvas
 
-        edges = tr.backface_edge_culling(edges, backface_indices)
-        edges = tr.backface_edge_culling(edges, face_indices)
-        self.render_edges(vertices, edges)
+        Frames older than the one on the canvas are dropped, returning False.
+        Drawing stages are timed into the profiler `record` of the frame.
+        """
+        if seq < self._shown_frame_seq:
+            return False
+        self._shown_frame_seq = seq
+        if self.direct_draw:
+            self.canvas.set_frame(frame, record)
+            self.canvas.clear()
+        else:
+            self._canvas_target.draw(frame, record)
+        if self._show_profile:
+            self._canvas_target.draw_overlay(self._profiler.overlay_lines())
+        self._polygons_display.text = '{} Polygons'.format(len(frame.faces))
 
         #self.draw_color_ramp()
 
@@ -261,70 +411,7 @@ class Shapes(toga.App):
         #         path.line_to(cw/4, cw/2)
 
         self.canvas.redraw()
-
-    def render_faces(self, vertices, faces, colors):
-        pol_count = 0
-        for f, color in zip(faces, colors):
-            with self.canvas.fill(color=color) as fill:
-                with fill.closed_path(vertices[f[0]][0], vertices[f[0]][2]) as polygon:
-                    for v in f[1:]:
-                        polygon.line_to(vertices[v][0], vertices[v][2])
-            pol_count += 1
-
-        self._polygons_display.text = '{} Polygons'.format(pol_count)
-
-    def render_edges(self, vertices, edges):
-        cw = self.canvas.layout.content_width
-
-        edges_by_vertices = dict()
-        for i, e in enumerate(edges):
-            edges_by_vertices.setdefault(e[0], deque()).append(i)
-            edges_by_vertices.setdefault(e[1], deque()).append(i)
-
-        if not edges_by_vertices:
-            return
-
-        # with self.canvas.fill(color='red') as fill:
-        #    edge_i = next(iter(edges_by_vertices.values()))[0]
-        #    edge = edges[edge_i]
-        #    fill.arc(vertices[edge[0]][0], vertices[edge[0]][2], 7)
-
-        with self.canvas.stroke(color='black', line_width=max(cw*0.01, 4.0)) as stroke:
-            while edges_by_vertices:
-                edge_i = next(iter(edges_by_vertices.values()))[0]
-                edge = edges[edge_i]
-                #starting_point = edge[0]
-                #stroke.move_to(vertices[edge[0]][0], vertices[edge[0]][2])
-                with stroke.closed_path(vertices[edge[0]][0], vertices[edge[0]][2]) as line:
-                    while True:
-                        #stroke.line_to(vertices[edge[1]][0], vertices[edge[1]][2])
-                        #if edge[1] == starting_point:
-                        #    stroke.closed_path(vertices[edge[1]][0], vertices[edge[1]][2])
-                        edges_by_vertices[edge[0]].remove(edge_i)
-                        edges_by_vertices[edge[1]].remove(edge_i)
-                        if not edges_by_vertices[edge[0]]:
-                            # If its the last edge starting with the vertex,
-                            # remove the dequeue
-                            del(edges_by_vertices[edge[0]])
-                        if not edges_by_vertices[edge[1]]:
-                            # If its the last edge ending with the vertex,
-                            # remove the dequeue and exit the loop before
-                            # drawing because the `closed_path` context will
-                            # close the polygon for us
-                            del(edges_by_vertices[edge[1]])
-                            break
-                        line.line_to(vertices[edge[1]][0], vertices[edge[1]][2])
-                        next_idx = edge[1]
-                        edge_i = edges_by_vertices[next_idx][0]
-                        edge = edges[edge_i]
-                        if edge[1] == next_idx:
-                            # If next edge found ends with the vertex with
-                            # sitting on, flip its direction.
-                            edge[0], edge[1] = edge[1], edge[0]
-
-            #for e in edges:
-            #    stroke.move_to(vertices[e[0]][0], vertices[e[0]][2])
-            #    stroke.line_to(vertices[e[1]][0], vertices[e[1]][2])
+        return True
 
     def draw_color_ramp(self, base_color=None, amount=40, x=0, y=0, w=None, h=20):
         if base_color is None:
@@ -335,44 +422,54 @@ class Shapes(toga.App):
         for i in range(0, amount):
             angle = pi * i / amount
             ang_cos = cos(angle)
-            color = color_ramp(base_color, ang_cos)
+            color = rgb(*renderer.color_ramp(base_color, ang_cos))
             with self.canvas.fill(color=color) as fill:
                 fill.rect(w * i / amount + x, y, w / amount + 1, h)
 
     def set_draw_shape(self, widget):
-        shape_func = models.cylinder
         print('selected shape: {}'.format(self.shape_select.value))
-        if self.shape_select.value == 'Cone':
-            shape_func = models.cone
-        elif self.shape_select.value == 'Duble Cone':
-            shape_func = models.duble_cone
-        self._draw_shape = shape_func(int(self.shape_segments.value))
-        self.render()
-
-# this is needed because 'partial' does not work well on async functions until
-# Python 3.8
-def async_partial(func, *args, **kwargs):
-    async def _newfunc(*nargs, **nkwargs):
-        kwargs.update(nkwargs)
-        return await func(*args, *nargs, **kwargs)
-    return _newfunc
-
-def color_ramp(base_color, ang_cos):
-    edge_percent = 0.8
-    if ang_cos > 0:
-        factor = (1 - ang_cos) * edge_percent + (1. - edge_percent)
-        return rgb(
-            r=int(base_color.r * factor),
-            g=int(base_color.g * factor),
-            b=int(base_color.b * factor),
-        )
-    else:
-        factor = (1 + ang_cos) * edge_percent + (1. - edge_percent)
-        return rgb(
-            r=int(base_color.r * factor + 255 * (1-factor)),
-            g=int(base_color.g * factor + 255 * (1-factor)),
-            b=int(base_color.b * factor + 255 * (1-factor)),
-        )
+        if self.shape_select.value in self._imported:
+            # Loaded shapes have a single level of detail
+            levels = None
+            self._draw_shape = self._imported[self.shape_select.value]
+        else:
+            shape_kind = self.shape_kinds.get(
+                self.shape_select.value, 'cylinder'
+            )
+            # The segments input sets the most detailed level, less detailed
+            # ones get used when the shape shows small
+            levels = self._meshes.levels(
+                shape_kind, int(self.shape_segments.value)
+            )
+            self._draw_shape = levels[0][1]
+        self._scene_object.shape = self._draw_shape
+        self._scene_object.levels = levels
+        self.request_render()
+
+    async def load_shape(self, widget):
+        try:
+            path = self.main_window.open_file_dialog(
+                'Load shape', file_types=list(importers.LOADERS)
+            )
+        except ValueError:
+            # The dialog was cancelled
+            return
+        # Parsing large files takes a while, so keep it off the event loop
+        try:
+            shape = await self._impl.loop.run_in_executor(
+                None, self._meshes.get_file, path, importers.load
+            )
+        except (OSError, ValueError) as e:
+            self.main_window.error_dialog(
+                'Load shape', 'Could not load {}:\n{}'.format(path, e)
+            )
+            return
+        name = os.path.basename(path)
+        self._imported[name] = shape
+        self.shape_select.items = \
+            list(self.shape_kinds) + list(self._imported)
+        self.shape_select.value = name
+        self.set_draw_shape(widget)
 
 def main():
     return Shapes()
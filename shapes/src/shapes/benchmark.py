@@ -0,0 +1,330 @@
+"""benchmark.py - headless benchmarks of the models and render pipeline
+
+Run with `python -m shapes.benchmark`. Results can be saved with `--output`
+and compared to a previous run with `--compare`, in which case the exit code
+is non-zero if any timing regressed by more than `--threshold`.
+"""
+from collections import Counter
+from contextlib import contextmanager
+from math import pi
+from time import perf_counter
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import numpy as np
+from travertino.colors import rgb
+
+from . import transforms as tr
+from . import models
+from . import renderer
+from . import raster
+from .profiler import FrameProfiler
+from .scene import Scene
+
+DEFAULT_SEGMENTS = [4, 8, 16, 32, 64, 128]
+BUILD_REPEATS = 5
+# Timing differences below this are noise, not regressions
+MIN_DELTA_MS = 0.05
+WIDTH = HEIGHT = 400
+COLOR = rgb(0, 0, 128)
+
+
+class FakeCanvas:
+    """Stand-in for a Toga `Canvas` that only counts the drawing calls made"""
+    def __init__(self):
+        self.calls = Counter()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self._call(name)
+
+    def _call(self, name):
+        def call(*args, **kwargs):
+            self.calls[name] += 1
+        return call
+
+    @contextmanager
+    def _context(self, name):
+        self.calls[name] += 1
+        yield self
+
+    def fill(self, *args, **kwargs):
+        return self._context('fill')
+
+    def stroke(self, *args, **kwargs):
+        return self._context('stroke')
+
+    def closed_path(self, *args, **kwargs):
+        return self._context('closed_path')
+
+
+def benchmark_shape(kind, segments, frames):
+    build_times = []
+    for _ in range(BUILD_REPEATS):
+        start = perf_counter()
+        shape = models.SHAPES[kind](segments)
+        build_times.append(perf_counter() - start)
+
+    pipeline = tr.Pipeline()
+    profiler = FrameProfiler(window=frames)
+    canvas = FakeCanvas()
+    canvas_target = renderer.CanvasTarget(canvas)
+    framebuffer = raster.Framebuffer(WIDTH, HEIGHT)
+    raster_times = []
+    polygons = 0
+    for i in range(frames):
+        angle = 2 * pi * i / frames
+        pipeline.update(angle, angle / 3, WIDTH, HEIGHT)
+        profiler.begin_frame()
+        frame = renderer.prepare_frame(shape, pipeline, COLOR, profiler)
+        canvas_target.draw(frame, profiler)
+        start = perf_counter()
+        framebuffer.draw(frame)
+        raster_times.append(perf_counter() - start)
+        polygons += len(frame.faces)
+
+    result = {'build_ms': min(build_times) * 1000.}
+    for name, percentiles in profiler.summary().items():
+        result[name + '_ms'] = percentiles['p50']
+    result['raster_ms'] = float(np.median(raster_times)) * 1000.
+    result['polygons'] = polygons / frames
+    result['draw_calls'] = sum(canvas.calls.values()) / frames
+    return result
+
+def benchmark_scene(
+    objects, frames, segments=16, instanced=False, lod=False
+):
+    """Time preparing a frame of a grid of `objects` overlapping shapes
+
+    The shapes are either separate scene objects of all kinds, or instances
+    of a single shape. With `lod`, they get levels of detail starting at
+    `segments`.
+    """
+    meshes = models.MeshCache()
+    side = int(np.ceil(np.sqrt(objects)))
+    size = 2. / side
+    transforms = [
+        tr.scale(size / 2, size / 2, size / 2) @ tr.move(
+            -1 + size * (col + 0.5), -1 + size * (row + 0.5), 0.
+        )
+        for row, col in (divmod(i, side) for i in range(objects))
+    ]
+    scene = Scene()
+    if instanced:
+        instances = scene.add_instances(
+            meshes.get('cylinder', segments), transforms, [COLOR] * objects
+        )
+        if lod:
+            instances.levels = meshes.levels('cylinder', segments)
+    else:
+        kinds = list(models.SHAPES)
+        for i, transform in enumerate(transforms):
+            kind = kinds[i % len(kinds)]
+            obj = scene.add(meshes.get(kind, segments), COLOR, transform)
+            if lod:
+                obj.levels = meshes.levels(kind, segments)
+
+    pipeline = tr.Pipeline()
+    profiler = FrameProfiler(window=frames)
+    polygons = 0
+    for i in range(frames):
+        angle = 2 * pi * i / frames
+        pipeline.update(angle, angle / 3, WIDTH, HEIGHT)
+        profiler.begin_frame()
+        shapes = scene.select_levels(pipeline)
+        frame = renderer.prepare_scene(
+            scene, pipeline, profiler, shapes=shapes
+        )
+        polygons += len(frame.faces)
+
+    result = dict()
+    for name, percentiles in profiler.summary().items():
+        result[name + '_ms'] = percentiles['p50']
+    result['polygons'] = polygons / frames
+    return result
+
+def run(kinds, segments, frames, scenes=(), instances=(), lod=False):
+    results = {
+        '{}-{}'.format(kind, n): benchmark_shape(kind, n, frames)
+        for kind in kinds
+        for n in segments
+    }
+    for objects in scenes:
+        results['scene-{}'.format(objects)] = \
+            benchmark_scene(objects, frames, lod=lod)
+    for objects in instances:
+        results['instances-{}'.format(objects)] = \
+            benchmark_scene(objects, frames, instanced=True, lod=lod)
+    return results
+
+def compare(results, baseline, threshold):
+    """Find timings that got slower than the baseline by over `threshold`
+
+    Polygon and draw call counts are expected not to grow at all.
+    """
+    regressions = []
+    for case, metrics in results.items():
+        for name, value in metrics.items():
+            base = baseline.get(case, {}).get(name)
+            if base is None:
+                continue
+            if name.endswith('_ms'):
+                regressed = value > base * (1 + threshold) \
+                    and value - base > MIN_DELTA_MS
+            else:
+                regressed = value > base
+            if regressed:
+                regressions.append((case, name, base, value))
+    return regressions
+
+def check_frames(kinds, segments, frames):
+    """Check the frame pipeline dtypes and scratch array reuse
+
+    Shapes and frames must not get promoted to float64, and once frames were
+    prepared through a whole turn, doing another must not reallocate any
+    arena arrays. Returns a list of the problems found.
+    """
+    problems = []
+    for kind in kinds:
+        for n in segments:
+            case = '{}-{}'.format(kind, n)
+            shape = models.SHAPES[kind](n)
+            arrays = [
+                ('vertices', shape.vertices), ('normals', shape.normals),
+                ('centroids', shape.centroids), ('edges', shape.edges),
+                ('face_indices', shape.faces.indices),
+            ]
+            scene = Scene()
+            scene.add(shape, COLOR)
+            pipeline = tr.Pipeline()
+            frame_arena, scene_arena = tr.Arena(), tr.Arena()
+            for turn in range(2):
+                allocations = (
+                    frame_arena.allocations, scene_arena.allocations
+                )
+                for i in range(frames):
+                    angle = 2 * pi * i / frames
+                    pipeline.update(angle, angle / 3, WIDTH, HEIGHT)
+                    for frame in (
+                        renderer.prepare_frame(
+                            shape, pipeline, COLOR, arena=frame_arena
+                        ),
+                        renderer.prepare_scene(
+                            scene, pipeline, arena=scene_arena
+                        ),
+                    ):
+                        arrays += [
+                            ('points', frame.points), ('colors', frame.colors)
+                        ]
+            if allocations != (
+                frame_arena.allocations, scene_arena.allocations
+            ):
+                problems.append('{}: arena arrays reallocated'.format(case))
+            arrays += list(frame_arena) + list(scene_arena)
+            arrays += list(pipeline.arena)
+            promoted = sorted(set(
+                str(name) for name, a in arrays if a.dtype == np.float64
+            ))
+            if promoted:
+                problems.append('{}: float64 arrays: {}'.format(
+                    case, ', '.join(promoted)
+                ))
+    return problems
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True,
+            universal_newlines=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_results(results):
+    columns = sorted(set(name for m in results.values() for name in m))
+    print('{:<16}'.format('case') + ''.join(
+        '{:>14}'.format(name) for name in columns
+    ))
+    for case, metrics in results.items():
+        print('{:<16}'.format(case) + ''.join(
+            '{:>14.3f}'.format(metrics.get(name, float('nan')))
+            for name in columns
+        ))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--kinds', nargs='+', default=list(models.SHAPES),
+        choices=list(models.SHAPES),
+    )
+    parser.add_argument(
+        '--segments', nargs='+', type=int, default=DEFAULT_SEGMENTS
+    )
+    parser.add_argument('--frames', type=int, default=100)
+    parser.add_argument(
+        '--scenes', nargs='*', type=int, default=[], metavar='OBJECTS',
+        help='also benchmark scenes with these amounts of objects'
+    )
+    parser.add_argument(
+        '--instances', nargs='*', type=int, default=[], metavar='OBJECTS',
+        help='also benchmark scenes with these amounts of shape instances'
+    )
+    parser.add_argument(
+        '--lod', action='store_true',
+        help='give the shapes of benchmarked scenes levels of detail'
+    )
+    parser.add_argument('--output', help='JSON file to store the results in')
+    parser.add_argument('--compare', help='JSON results of a previous run')
+    parser.add_argument('--threshold', type=float, default=0.2)
+    parser.add_argument(
+        '--check', action='store_true',
+        help='only check frames for float64 promotion and reallocations'
+    )
+    args = parser.parse_args(argv)
+
+    if args.check:
+        problems = check_frames(args.kinds, args.segments, args.frames)
+        for problem in problems:
+            print('CHECK FAILED {}'.format(problem))
+        if problems:
+            return 1
+        print('Frame checks passed')
+        return 0
+
+    results = run(
+        args.kinds, args.segments, args.frames, args.scenes, args.instances,
+        args.lod
+    )
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'commit': git_commit(),
+                'python': platform.python_version(),
+                'numpy': np.__version__,
+                'frames': args.frames,
+                'results': results,
+            }, f, indent=1)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline['results'], args.threshold)
+        for case, name, base, value in regressions:
+            print('REGRESSION {} {}: {:.3f} -> {:.3f}'.format(
+                case, name, base, value
+            ))
+        if regressions:
+            return 1
+        print('No regressions compared to {}'.format(
+            baseline.get('commit') or args.compare
+        ))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,216 @@
+"""importers.py - load OBJ and binary STL meshes as shapes
+
+Files are read in chunks so large meshes never need a whole copy of the file,
+or of a list of Python objects per triangle, in memory at once.
+"""
+from pathlib import Path
+import os
+import re
+import struct
+import warnings
+import numpy as np
+
+from . import models
+
+# Triangles per binary STL read, and bytes of lines per OBJ read
+STL_CHUNK = 1 << 16
+OBJ_CHUNK = 1 << 22
+
+# Bytes that separate OBJ tokens, like for `bytes.split`
+OBJ_WHITESPACE = np.zeros(256, dtype=bool)
+OBJ_WHITESPACE[list(b' \t\n\r\x0b\x0c')] = True
+# Texture coordinate and normal indices of face corners, as in "f 1/2/3 ..."
+OBJ_CORNER_ATTRIBUTES = re.compile(rb'/\S*')
+
+STL_HEADER = 84
+STL_TRIANGLE = np.dtype([
+    ('normal', '<f4', (3,)),
+    ('vertices', '<f4', (3, 3)),
+    ('attributes', '<u2'),
+])
+
+
+def load(path, normalize=True):
+    """Load a mesh file, picking the importer by the file suffix
+
+    With `normalize`, the mesh is centered on the origin and scaled to fit the
+    unit sphere like the generated shapes.
+    """
+    suffix = Path(path).suffix.lower()[1:]
+    if suffix not in LOADERS:
+        raise ValueError('{}: unsupported mesh file type'.format(path))
+    return LOADERS[suffix](path, normalize)
+
+def load_stl(path, normalize=True):
+    """Load a binary STL file
+
+    The triangle normals stored in the file are ignored, they are computed
+    from the vertex winding like for all other shapes.
+    """
+    with open(path, 'rb') as f:
+        header = f.read(STL_HEADER)
+        size = os.fstat(f.fileno()).st_size
+        if len(header) < STL_HEADER:
+            raise ValueError('{}: not a binary STL file'.format(path))
+        count, = struct.unpack('<I', header[80:])
+        if size < STL_HEADER + count * STL_TRIANGLE.itemsize:
+            # ASCII STL files start with "solid" and then have text where
+            # the triangle count should be
+            raise ValueError('{}: not a binary STL file'.format(path))
+        corners = np.empty((count, 3, 3), dtype=np.float32)
+        for start in range(0, count, STL_CHUNK):
+            n = min(STL_CHUNK, count - start)
+            records = np.frombuffer(
+                f.read(n * STL_TRIANGLE.itemsize), dtype=STL_TRIANGLE
+            )
+            corners[start:start+n] = records['vertices']
+    vertices, indices = _deduplicate(corners.reshape(-1, 3))
+    del corners
+    triangles = indices.reshape(-1, 3)
+    degenerate = (triangles[:, 0] == triangles[:, 1]) | \
+        (triangles[:, 1] == triangles[:, 2]) | \
+        (triangles[:, 2] == triangles[:, 0])
+    triangles = triangles[~degenerate]
+    faces = models.Faces(
+        triangles.ravel(), np.arange(0, triangles.size + 1, 3)
+    )
+    return _shape(vertices, faces, normalize)
+
+def load_obj(path, normalize=True):
+    """Load the vertices and faces of an OBJ file
+
+    Faces may have any amount of vertices, and texture coordinate and normal
+    indices of face vertices are ignored.
+    """
+    vertex_chunks, index_chunks, size_chunks = [], [], []
+    n_vertices = 0
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(OBJ_CHUNK)
+            if not chunk:
+                break
+            # Complete the last line
+            chunk += f.readline()
+            try:
+                vertices, indices, sizes = _parse_obj(chunk, n_vertices)
+            except ValueError as e:
+                raise ValueError('{}: {}'.format(path, e)) from None
+            vertex_chunks.append(vertices)
+            index_chunks.append(indices)
+            size_chunks.append(sizes)
+            n_vertices += len(vertices)
+
+    vertices = np.concatenate(vertex_chunks) if vertex_chunks \
+        else np.empty((0, 3), dtype=np.float32)
+    indices = np.concatenate(index_chunks) if index_chunks \
+        else np.empty(0, dtype=np.int64)
+    sizes = np.concatenate(size_chunks) if size_chunks \
+        else np.empty(0, dtype=np.int32)
+    if len(indices) and (indices.min() < 0 or indices.max() >= n_vertices):
+        raise ValueError('{}: face vertex index out of range'.format(path))
+    vertices, remap = _deduplicate(vertices)
+    offsets = np.zeros(len(sizes) + 1, dtype=np.int32)
+    np.cumsum(sizes, out=offsets[1:])
+    faces = models.Faces(remap[indices], offsets)
+    faces = faces[sizes >= 3]
+    return _shape(vertices, faces, normalize)
+
+LOADERS = {
+    'obj': load_obj,
+    'stl': load_stl,
+}
+
+
+def _parse_obj(chunk, n_vertices):
+    """Parse the vertices and faces out of whole lines of an OBJ file
+
+    Rather than going line by line, the tokens of all the lines are found at
+    once from a whitespace mask of the bytes, and their numbers parsed in
+    bulk. `n_vertices` is the amount of vertices in the lines before, which
+    negative indices count back from. Returns the (N, 3) vertices, the zero
+    based vertex index of every face corner and the corner count of every
+    face.
+    """
+    chunk = OBJ_CORNER_ATTRIBUTES.sub(b'', chunk)
+    # Padded so that every token has whitespace before and after it
+    data = np.frombuffer(b' ' + chunk + b'\n', dtype=np.uint8)
+    space = OBJ_WHITESPACE[data]
+    starts = np.flatnonzero(space[:-1] & ~space[1:]) + 1
+    ends = np.flatnonzero(~space[:-1] & space[1:]) + 1
+
+    # The first token of each line is its keyword, and the column of every
+    # token is its position in its line
+    lines = np.searchsorted(np.flatnonzero(data == ord('\n')), starts)
+    line_starts = np.diff(lines, prepend=-1) != 0
+    firsts = np.flatnonzero(line_starts)
+    line_of = np.cumsum(line_starts) - 1
+    columns = np.arange(len(starts)) - firsts[line_of]
+    counts = np.diff(firsts, append=len(starts))
+    keywords = np.where(
+        ends[firsts] - starts[firsts] == 1, data[starts[firsts]], 0
+    )
+    vertex_lines = keywords == ord('v')
+    face_lines = keywords == ord('f')
+    if (counts[vertex_lines] < 4).any():
+        raise ValueError('vertex with less than 3 coordinates')
+
+    coordinates = vertex_lines[line_of] & (columns >= 1) & (columns <= 3)
+    vertices = _parse_numbers(
+        data, starts[coordinates], ends[coordinates], np.float32
+    ).reshape(-1, 3)
+    corners = face_lines[line_of] & (columns >= 1)
+    indices = _parse_numbers(data, starts[corners], ends[corners], np.int64)
+    # Negative indices count back from the vertices defined so far
+    defined = n_vertices + np.cumsum(vertex_lines)[line_of[corners]]
+    indices = np.where(indices < 0, defined + indices, indices - 1)
+    sizes = (counts[face_lines] - 1).astype(np.int32)
+    return vertices, indices, sizes
+
+def _parse_numbers(data, starts, ends, dtype):
+    """Parse the tokens of a byte array from `starts` to `ends` as numbers"""
+    if not len(starts):
+        return np.empty(0, dtype=dtype)
+    # Blanking out all the other bytes lets NumPy parse them in a single go
+    marks = np.zeros(len(data), dtype=np.int8)
+    marks[starts] = 1
+    marks[ends] = -1
+    inside = np.cumsum(marks, dtype=np.int8).view(bool)
+    text = np.where(inside, data, np.uint8(ord(' '))).tobytes()
+    try:
+        with warnings.catch_warnings():
+            # Older NumPy versions stop at text that is not a number with
+            # a warning rather than an error
+            warnings.simplefilter('ignore', DeprecationWarning)
+            numbers = np.fromstring(text, dtype=dtype, sep=' ')
+    except ValueError:
+        numbers = None
+    if numbers is None or len(numbers) != len(starts):
+        raise ValueError('invalid number')
+    return numbers
+
+def _deduplicate(points):
+    """Merge (N, 3) float32 points with the exact same coordinates
+
+    Returns the unique points and the index of each point among them.
+    """
+    # Adding zero turns -0.0 into 0.0, which would not compare equal as
+    # bytes otherwise
+    points = np.ascontiguousarray(points + np.float32(0))
+    # Comparing the rows as opaque 12 byte values sorts much faster than
+    # `np.unique(axis=0)` does
+    keys = points.view(np.dtype((np.void, points.itemsize * 3))).ravel()
+    keys, inverse = np.unique(keys, return_inverse=True)
+    unique = keys.view(np.float32).reshape(-1, 3)
+    return unique, inverse.ravel().astype(np.int32)
+
+def _shape(vertices, faces, normalize):
+    if not len(faces):
+        raise ValueError('mesh has no faces')
+    if normalize:
+        used = vertices[np.unique(faces.indices)]
+        center = (used.min(axis=0) + used.max(axis=0)) / 2
+        radius = np.sqrt(((used - center) ** 2).sum(axis=1).max())
+        vertices = vertices - center
+        if radius > 0:
+            vertices /= radius
+    return models.mesh(vertices, faces)
@@ -0,0 +1,100 @@
+"""meshfile.py - binary mesh array files that can be memory mapped
+
+A mesh file is a header followed by the raw arrays of a shape:
+
+    magic       8 bytes, b'SHAPEMSH'
+    version     uint32
+    count       uint32, amount of arrays
+    count times:
+        name    32 bytes, ASCII, NUL padded
+        dtype   8 bytes, numpy dtype string like b'<f4', NUL padded
+        rows    uint64
+        columns uint64, 0 for 1-d arrays
+        offset  uint64, from the start of the file
+
+All integers are little endian, and every array starts at a multiple of
+`ALIGNMENT` bytes. Loading maps the file read-only and makes arrays that
+point straight into the mapping, so nothing gets parsed or copied, and
+processes loading the same file share its pages.
+"""
+import struct
+import numpy as np
+
+MAGIC = b'SHAPEMSH'
+VERSION = 1
+ALIGNMENT = 64
+
+_HEADER = struct.Struct('<8sII')
+_NAME_SIZE = 32
+_ENTRY = struct.Struct('<{}s8sQQQ'.format(_NAME_SIZE))
+
+
+def save(f, arrays):
+    """Write 1-d and 2-d arrays to a binary file object
+
+    `arrays` is a list of (name, array) pairs.
+    """
+    entries = []
+    offset = _aligned(_HEADER.size + _ENTRY.size * len(arrays))
+    for name, a in arrays:
+        if a.ndim not in (1, 2):
+            raise ValueError(
+                '{}: only 1-d and 2-d arrays can be stored'.format(name)
+            )
+        if len(name.encode('ascii')) > _NAME_SIZE:
+            raise ValueError('{}: array name too long'.format(name))
+        a = np.ascontiguousarray(a, dtype=a.dtype.newbyteorder('<'))
+        entries.append((name, a, offset))
+        offset = _aligned(offset + a.nbytes)
+    end = offset
+
+    f.write(_HEADER.pack(MAGIC, VERSION, len(entries)))
+    for name, a, offset in entries:
+        rows, columns = a.shape if a.ndim == 2 else (len(a), 0)
+        f.write(_ENTRY.pack(
+            name.encode('ascii'), a.dtype.str.encode('ascii'),
+            rows, columns, offset
+        ))
+    position = _HEADER.size + _ENTRY.size * len(entries)
+    for name, a, offset in entries:
+        f.write(bytes(offset - position))
+        f.write(a.data)
+        position = offset + a.nbytes
+    f.write(bytes(end - position))
+
+def load(path):
+    """Map a mesh file and get its arrays by name
+
+    The arrays are read-only. Raises `ValueError` if the file is not a mesh
+    file, is of another version or is truncated.
+    """
+    data = np.memmap(path, dtype=np.uint8, mode='r')
+    if len(data) < _HEADER.size:
+        raise ValueError('{}: not a mesh file'.format(path))
+    magic, version, count = _HEADER.unpack(data[:_HEADER.size].tobytes())
+    if magic != MAGIC:
+        raise ValueError('{}: not a mesh file'.format(path))
+    if version != VERSION:
+        raise ValueError('{}: unsupported mesh file version {}'.format(
+            path, version
+        ))
+    if len(data) < _HEADER.size + _ENTRY.size * count:
+        raise ValueError('{}: truncated mesh file'.format(path))
+    arrays = dict()
+    for i in range(count):
+        start = _HEADER.size + _ENTRY.size * i
+        name, dtype, rows, columns, offset = \
+            _ENTRY.unpack(data[start:start+_ENTRY.size].tobytes())
+        dtype = np.dtype(dtype.rstrip(b'\0').decode('ascii'))
+        shape = (rows, columns) if columns else (rows,)
+        if offset + dtype.itemsize * rows * max(columns, 1) > len(data):
+            raise ValueError('{}: truncated mesh file'.format(path))
+        # Plain arrays on the buffer of the mapping, which stays mapped for
+        # as long as any of them is alive
+        arrays[name.rstrip(b'\0').decode('ascii')] = \
+            np.ndarray(shape, dtype=dtype, buffer=data, offset=offset)
+    return arrays
+
+
+def _aligned(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
@@ -1,12 +1,135 @@
 """models.py - numpy-based 3d models
 """
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from pathlib import Path
+import hashlib
+import os
+import tempfile
 import numpy as np
 from math import pi, tan
 
 from . import transforms as tr
+from . import meshfile
+
+# Coordinates are float32 and indices int32 throughout
+Shape = namedtuple(
+    'Shape',
+    ['vertices', 'faces', 'normals', 'centroids', 'edges', 'adjacency']
+)
+Adjacency = namedtuple('Adjacency', ['offsets', 'edges'])
+
+
+class Faces:
+    """Polygon faces stored as a flat array of vertex indices
+
+    The vertices of face `i` are `indices[offsets[i]:offsets[i+1]]`, so faces
+    with different amounts of vertices can be processed together.
+    """
+    def __init__(self, indices, offsets):
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.offsets = np.asarray(offsets, dtype=np.int32)
+        self._triangles = None
+
+    @classmethod
+    def from_lists(cls, faces):
+        sizes = [len(f) for f in faces]
+        offsets = np.zeros(len(faces) + 1, dtype=np.int32)
+        np.cumsum(sizes, out=offsets[1:])
+        if faces:
+            indices = np.concatenate([np.asarray(f) for f in faces])
+        else:
+            indices = np.empty(0)
+        return cls(indices, offsets)
+
+    @classmethod
+    def concatenate(cls, faces, vertex_offsets):
+        """Join faces of several meshes whose vertices got concatenated
+
+        `vertex_offsets` are the positions of the vertices of each mesh in
+        the joint vertex array.
+        """
+        sizes = [f.sizes for f in faces]
+        offsets = np.zeros(sum(len(f) for f in faces) + 1, dtype=np.int32)
+        if sizes:
+            np.cumsum(np.concatenate(sizes), out=offsets[1:])
+            indices = np.concatenate([
+                f.indices + offset for f, offset in zip(faces, vertex_offsets)
+            ])
+        else:
+            indices = np.empty(0)
+        return cls(indices, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        bounds = self.offsets.tolist()
+        for st, end in zip(bounds[:-1], bounds[1:]):
+            yield self.indices[st:end]
+
+    def __getitem__(self, key):
+        """Get the vertices of a single face, or select faces by index,
+        boolean mask or slice"""
+        if np.isscalar(key):
+            return self.indices[self.offsets[key]:self.offsets[key+1]]
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step == 1:
+                # A run of faces is a view of the indices
+                offsets = self.offsets[start:max(start, stop) + 1]
+                return Faces(
+                    self.indices[offsets[0]:offsets[-1]], offsets - offsets[0]
+                )
+            key = np.arange(start, stop, step)
+        key = np.asarray(key)
+        if key.dtype == bool:
+            key = np.flatnonzero(key)
+        sizes = self.sizes[key]
+        offsets = np.zeros(len(key) + 1, dtype=np.int32)
+        np.cumsum(sizes, out=offsets[1:])
+        sources = np.arange(offsets[-1]) + \
+            np.repeat(self.offsets[key] - offsets[:-1], sizes)
+        return Faces(self.indices[sources], offsets)
+
+    @property
+    def sizes(self):
+        return np.diff(self.offsets)
+
+    @property
+    def nbytes(self):
+        return self.indices.nbytes + self.offsets.nbytes
+
+    def column(self, n):
+        """Get the n-th vertex index of every face"""
+        return self.indices[self.offsets[:-1] + n]
+
+    def triangles(self):
+        """Get the faces split into fans of triangles
+
+        Returns a (T, 3) array of vertex indices and the face index of each
+        triangle.
+        """
+        if self._triangles is None:
+            tri_counts = self.sizes - 2
+            tri_faces = np.repeat(np.arange(len(self)), tri_counts)
+            tri_offsets = np.cumsum(tri_counts) - tri_counts
+            tri_vertices = np.arange(len(tri_faces)) - \
+                np.repeat(tri_offsets, tri_counts) + 1
+            first = self.offsets[tri_faces]
+            triangles = np.stack((
+                self.indices[first],
+                self.indices[first + tri_vertices],
+                self.indices[first + tri_vertices + 1],
+            ), axis=1)
+            self._triangles = (triangles, tri_faces)
+        return self._triangles
+
+    def read_only(self):
+        faces = Faces(self.indices.copy(), self.offsets.copy())
+        faces.indices.setflags(write=False)
+        faces.offsets.setflags(write=False)
+        return faces
 
-Shape = namedtuple('Shape', ['vertices', 'faces', 'normals', 'edges'])
 
 def box():
     return cylinder(4)
@@ -22,14 +145,49 @@ def duble_cone(segments):
     s = extruder(segments).start_point().extrude_poly(1).extrude_point(1).shape()
     return(s)
 
-def polygon(segments):
-    point = np.array([tan(pi/segments), 1., 0. ,1.], dtype=np.float32)
-    return np.array([
-        point @ tr.rotate_z(angle)
-        for angle in np.linspace(0, pi * 2, segments, endpoint=False)
-    ])
+def lathe(segments, profile):
+    """Make a solid of revolution out of a list of (z, radius) points
+
+    Points with a zero radius become a cone tip, others a polygon ring. If the
+    profile does not end with a point, the top of the shape is closed with a
+    polygon face.
+    """
+    (z, radius), *profile = profile
+    ext = extruder(segments)
+    if radius == 0:
+        ext.start_point(z)
+    else:
+        ext.start_poly(radius, z)
+    for z, radius in profile:
+        if radius == 0:
+            ext.extrude_point(z - ext.z)
+        else:
+            ext.extrude_poly(z - ext.z, radius)
+    return ext.close().shape()
+
+SHAPES = {
+    'cylinder': cylinder,
+    'cone': cone,
+    'duble_cone': duble_cone,
+}
+
+def polygon(segments, radius=1.):
+    angles = np.linspace(0, pi * 2, segments, endpoint=False)
+    x, y = tan(pi/segments) * radius, radius
+    vertices = np.empty((segments, 4), dtype=np.float32)
+    vertices[:, 0] = x * np.cos(angles) - y * np.sin(angles)
+    vertices[:, 1] = x * np.sin(angles) + y * np.cos(angles)
+    vertices[:, 2] = 0.
+    vertices[:, 3] = 1.
+    return vertices
 
 class extruder:
+    """Build shapes by extruding polygons and points along the Z axis
+
+    The extrusion methods only plan the shape and keep track of how large it
+    is going to be, `shape()` then allocates the shape arrays once and fills
+    them in with index tables computed for whole segment rings at a time.
+    """
     def __init__(self, segments):
         self.segments = segments
 
@@ -37,179 +195,547 @@ class extruder:
     FACE=1
     EDGE=2
 
-    def start_point(self ):
-        self.vertices = np.array([[0., 0., -1., 1.]], dtype=np.float32)
-        self.faces = []
-        self.edges = []
+    def start_point(self, z=-1.):
+        self._reset()
+        self._add_point(z)
         self.last = self.POINT
         return self
 
-    def start_poly(self):
-        self.vertices = polygon(self.segments) @ tr.move(0, 0, -1)
-        self.faces = [_polygon_face(self.segments, 0, True)]
-        self.edges = []
+    def start_poly(self, radius=1., z=-1.):
+        self._reset()
+        self._add_poly(z, radius)
+        self._add_faces(_polygon_face, self.segments, 0, True)
         self.last = self.FACE
         return self
 
     def extrude_point(self, dz):
-        extrude_z = self.vertices[-1, 2] + dz
+        extrude_z = self.z + dz
         if self.last == self.POINT:
             # If trying to extrude point form point - move the point
-            self.vertices[-1, 2] = extrude_z
+            self._vertex_plan[-1][0] = extrude_z
+            self.z = extrude_z
             return self
-        elif self.last == self.EDGE:
-            self.add_edges(_rim_edges(
-                self.segments,
-                len(self.vertices)-self.segments,
-                len(self.faces)-self.segments,
-                len(self.faces),
-            ))
-        else:
-            self.add_edges(_polygon_edges(
-                self.segments,
-                len(self.vertices)-self.segments,
-                len(self.faces)-1,
-                len(self.faces)
-            ))
-        self.add_vertices(np.array([[0., 0., extrude_z, 1]]))
-        self.add_edges(_cone_edges(
+        self._add_ring_edges(self.n_vertices-self.segments)
+        self._add_point(extrude_z)
+        self._add_edges(
+            _cone_edges,
             self.segments,
-            len(self.vertices)-1-self.segments,
-            len(self.vertices)-1,
-            len(self.faces)
-        ))
-        self.add_faces(_cone_faces(
+            self.n_vertices-1-self.segments,
+            self.n_vertices-1,
+            self.n_faces
+        )
+        self._add_faces(
+            _cone_faces,
             self.segments,
-            len(self.vertices)-1-self.segments,
-            len(self.vertices)-1,
-        ))
+            self.n_vertices-1-self.segments,
+            self.n_vertices-1,
+        )
         self.last=self.POINT
         return self
 
-    def extrude_poly(self, dz):
-        extrude_z = self.vertices[-1, 2] + dz
-        self.add_vertices(polygon(self.segments) @ tr.move(0, 0, extrude_z))
+    def extrude_poly(self, dz, radius=1.):
+        extrude_z = self.z + dz
+        self._add_poly(extrude_z, radius)
         if self.last == self.POINT:
-            self.add_edges(_cone_edges(
+            self._add_edges(
+                _cone_edges,
                 self.segments,
-                len(self.vertices)-self.segments,
-                len(self.vertices)-self.segments-1,
-                len(self.faces)
-            ))
-            self.add_faces(_cone_faces(
+                self.n_vertices-self.segments,
+                self.n_vertices-self.segments-1,
+                self.n_faces
+            )
+            self._add_faces(
+                _cone_faces,
                 self.segments,
-                len(self.vertices)-self.segments,
-                len(self.vertices)-self.segments-1,
-                flip_direction=True,
-            ))
-            self.last = self.EDGE
-            return self
+                self.n_vertices-self.segments,
+                self.n_vertices-self.segments-1,
+                True,
+            )
         else:
-            if self.last == self.EDGE:
-                self.add_edges(_rim_edges(
-                    self.segments,
-                    len(self.vertices)-self.segments*2,
-                    len(self.faces)-self.segments,
-                    len(self.faces),
-                ))
-            else:
-                self.add_edges(_polygon_edges(
-                    self.segments,
-                    len(self.vertices)-self.segments*2,
-                    len(self.faces)-1,
-                    len(self.faces),
-                ))
-            self.add_edges(_cylinder_edges(
+            self._add_ring_edges(self.n_vertices-self.segments*2)
+            self._add_edges(
+                _cylinder_edges,
                 self.segments,
-                len(self.vertices)-self.segments*2,
-                len(self.vertices)-self.segments,
-                len(self.faces)
-            ))
-            self.add_faces(_cylinder_faces(
+                self.n_vertices-self.segments*2,
+                self.n_vertices-self.segments,
+                self.n_faces
+            )
+            self._add_faces(
+                _cylinder_faces,
                 self.segments,
-                len(self.vertices)-self.segments*2,
-                len(self.vertices)-self.segments,
-            ))
-            self.last = self.EDGE
-            return self
+                self.n_vertices-self.segments*2,
+                self.n_vertices-self.segments,
+            )
+        self.last = self.EDGE
+        return self
 
     def close(self):
         if self.last == self.POINT or self.last == self.FACE:
             return self
-        self.add_edges(_polygon_edges(
+        self._add_edges(
+            _polygon_edges,
             self.segments,
-            len(self.vertices)-self.segments,
-            len(self.faces),
-            len(self.faces)-self.segments
-        ))
-        self.add_faces([_polygon_face(
+            self.n_vertices-self.segments,
+            self.n_faces,
+            self.n_faces-self.segments
+        )
+        self._add_faces(
+            _polygon_face,
             self.segments,
-            len(self.vertices)-self.segments
-        )])
+            self.n_vertices-self.segments
+        )
+        self.last = self.FACE
         return self
 
     def shape(self):
-        faces = np.array(self.faces)
-        edges = np.array(self.edges)
-        normals = tr.normals(self.vertices, self.faces)
-        normals = np.hstack((normals, np.ones((len(normals), 1))))
-        shape = Shape(self.vertices, faces, normals, edges)
+        vertices = np.empty((self.n_vertices, 4), dtype=np.float32)
+        vtx_st_i = 0
+        for z, radius in self._vertex_plan:
+            if radius is None:
+                vertices[vtx_st_i] = (0., 0., z, 1.)
+                vtx_st_i += 1
+            else:
+                vertices[vtx_st_i:vtx_st_i+self.segments] = \
+                    polygon(self.segments, radius)
+                vertices[vtx_st_i:vtx_st_i+self.segments, 2] = z
+                vtx_st_i += self.segments
+
+        face_indices = np.empty(self.n_face_indices, dtype=np.int32)
+        face_offsets = np.empty(self.n_faces + 1, dtype=np.int32)
+        face_offsets[0] = 0
+        face_i = idx_i = 0
+        for func, args in self._face_plan:
+            block = func(*args)
+            face_indices[idx_i:idx_i+block.size] = block.ravel()
+            face_offsets[face_i+1:face_i+len(block)+1] = \
+                idx_i + block.shape[1] * np.arange(1, len(block)+1)
+            face_i += len(block)
+            idx_i += block.size
+
+        edges = np.empty((self.n_edges, 4), dtype=np.int32)
+        edge_i = 0
+        for func, args in self._edge_plan:
+            block = func(*args)
+            edges[edge_i:edge_i+len(block)] = block
+            edge_i += len(block)
+
+        faces = Faces(face_indices, face_offsets)
+        normals = tr.normals(vertices, faces)
+        normals /= np.linalg.norm(normals, axis=1)[:, None]
+        centroids = tr.face_centroids(vertices, faces)
+        adjacency = vertex_edges(edges, len(vertices))
+        shape = Shape(vertices, faces, normals, centroids, edges, adjacency)
+        return shape
+
+    def _reset(self):
+        self.n_vertices = 0
+        self.n_faces = 0
+        self.n_face_indices = 0
+        self.n_edges = 0
+        self._vertex_plan = []
+        self._face_plan = []
+        self._edge_plan = []
+
+    def _add_point(self, z):
+        self._vertex_plan.append([z, None])
+        self.n_vertices += 1
+        self.z = z
+
+    def _add_poly(self, z, radius):
+        self._vertex_plan.append([z, radius])
+        self.n_vertices += self.segments
+        self.z = z
+
+    def _add_faces(self, func, *args):
+        n_faces, face_size = _FACE_BLOCKS[func](self.segments)
+        self.n_faces += n_faces
+        self.n_face_indices += n_faces * face_size
+        self._face_plan.append((func, args))
+
+    def _add_edges(self, func, *args):
+        self.n_edges += self.segments
+        self._edge_plan.append((func, args))
+
+    def _add_ring_edges(self, vtx_st_i):
+        """Add the edges around the last polygon ring or face"""
+        if self.last == self.EDGE:
+            self._add_edges(
+                _rim_edges,
+                self.segments,
+                vtx_st_i,
+                self.n_faces-self.segments,
+                self.n_faces,
+            )
+        else:
+            self._add_edges(
+                _polygon_edges,
+                self.segments,
+                vtx_st_i,
+                self.n_faces-1,
+                self.n_faces,
+            )
+
+
+def vertex_edges(edges, n_vertices):
+    """Build the vertex to edge adjacency of an edges table
+
+    The edges touching vertex `v` are
+    `adjacency.edges[adjacency.offsets[v]:adjacency.offsets[v+1]]`.
+    """
+    ends = edges[:, :2].ravel()
+    offsets = np.zeros(n_vertices + 1, dtype=np.int32)
+    np.cumsum(np.bincount(ends, minlength=n_vertices), out=offsets[1:])
+    adjacent = np.argsort(ends, kind='stable') // 2
+    return Adjacency(offsets, adjacent.astype(np.int32))
+
+def face_edges(faces, n_vertices):
+    """Build the edges table of a polygon mesh out of its faces
+
+    Each pair of consecutive face vertices is a half-edge, and half-edges
+    joining the same two vertices are sorted next to each other to find the
+    faces on both sides of an edge. Boundary edges get their only face on
+    both sides, and edges shared by over two faces keep the first two.
+    """
+    sizes = faces.sizes
+    n_face_indices = len(faces.indices)
+    following = np.arange(1, n_face_indices + 1)
+    last = faces.offsets[1:] - 1
+    following[last[sizes > 0]] = faces.offsets[:-1][sizes > 0]
+    start_vtx = faces.indices.astype(np.int64)
+    end_vtx = start_vtx[following]
+    keys = np.minimum(start_vtx, end_vtx) * n_vertices + \
+        np.maximum(start_vtx, end_vtx)
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    first = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    shared = np.r_[first[1:], len(keys)] - first > 1
+    half_edge_faces = np.repeat(np.arange(len(faces)), sizes)
+    edges = np.empty((len(first), 4), dtype=np.int32)
+    edges[:, 0] = start_vtx[order[first]]
+    edges[:, 1] = end_vtx[order[first]]
+    edges[:, 2] = half_edge_faces[order[first]]
+    edges[:, 3] = half_edge_faces[order[first + shared]]
+    return edges
+
+def mesh(vertices, faces):
+    """Make a shape out of (N, 3) vertex coordinates and their faces"""
+    n_vertices = len(vertices)
+    homogeneous = np.empty((n_vertices, 4), dtype=np.float32)
+    homogeneous[:, :3] = vertices
+    homogeneous[:, 3] = 1.
+    normals = tr.normals(homogeneous, faces)
+    lengths = np.linalg.norm(normals, axis=1)
+    # Leave the zero normals of degenerate faces as they are
+    lengths[lengths == 0] = 1.
+    normals /= lengths[:, None]
+    centroids = tr.face_centroids(homogeneous, faces)
+    edges = face_edges(faces, n_vertices)
+    adjacency = vertex_edges(edges, n_vertices)
+    return Shape(homogeneous, faces, normals, centroids, edges, adjacency)
+
+def repeat_topology(shape, count):
+    """Get the faces, edges and adjacency of `count` copies of a shape
+
+    The copies refer to the shape vertices repeated `count` times over, so
+    instances of a shape can be culled and outlined together.
+    """
+    copies = np.arange(count, dtype=np.int32)[:, None]
+    n_vertices, n_faces = len(shape.vertices), len(shape.faces)
+    faces, adjacency = shape.faces, shape.adjacency
+    faces = Faces(
+        (faces.indices + copies * n_vertices).ravel(),
+        _repeat_offsets(faces.offsets, copies),
+    )
+    edges = (
+        shape.edges[None] +
+        copies[:, :, None] * np.array([n_vertices] * 2 + [n_faces] * 2)
+    ).reshape(-1, 4).astype(shape.edges.dtype)
+    adjacency = Adjacency(
+        _repeat_offsets(adjacency.offsets, copies),
+        (adjacency.edges + copies * len(shape.edges)).ravel(),
+    )
+    return faces, edges, adjacency
+
+def convex(shape):
+    """Check if a closed shape is convex
+
+    It is when, across every edge, the centroid of the face on one side does
+    not lie in front of the face on the other side. A convex shape never
+    covers any of its own faces or outlines, whatever way it is seen from.
+    """
+    a, b = shape.edges[:, 2], shape.edges[:, 3]
+    offsets = shape.centroids[b, :3] - shape.centroids[a, :3]
+    folds = np.einsum('ij,ij->i', shape.normals[a], offsets)
+    return bool((folds <= 1e-5).all())
+
+def edge_loops(adjacency, edges, selected):
+    """Chain the edges selected by a mask into paths of vertex indices
+
+    The vertex to edge adjacency is filtered down to the selected edges in one
+    pass, after which each path is walked in time linear to its length.
+    Closed loops end with the vertex they start with.
+    """
+    selected_adjacent = selected[adjacency.edges]
+    adjacent_offsets = np.zeros(len(selected_adjacent) + 1, dtype=np.int32)
+    np.cumsum(selected_adjacent, out=adjacent_offsets[1:])
+    offsets = adjacent_offsets[adjacency.offsets].tolist()
+    adjacent = adjacency.edges[selected_adjacent].tolist()
+
+    selected = np.flatnonzero(selected)
+    ends = dict(zip(selected.tolist(), edges[selected, :2].tolist()))
+    remaining = set(ends)
+    cursors = dict()
+
+    def next_vertex(vtx):
+        """Consume an edge leaving `vtx`, and return its other end"""
+        cursor = cursors.get(vtx, offsets[vtx])
+        last = offsets[vtx+1]
+        while cursor < last:
+            edge_i = adjacent[cursor]
+            cursor += 1
+            if edge_i in remaining:
+                remaining.remove(edge_i)
+                cursors[vtx] = cursor
+                start, end = ends[edge_i]
+                return end if start == vtx else start
+        cursors[vtx] = cursor
+        return None
+
+    def walk(vtx):
+        path = []
+        while vtx is not None:
+            path.append(vtx)
+            vtx = next_vertex(vtx)
+        return path
+
+    paths = []
+    for edge_i, (start, end) in ends.items():
+        if edge_i not in remaining:
+            continue
+        remaining.remove(edge_i)
+        path = walk(end)
+        if path[-1] != start:
+            # We hit a dead end, so this is an open path - follow it the
+            # other way too
+            path = walk(start)[::-1] + path
+        else:
+            path.insert(0, start)
+        paths.append(np.array(path, dtype=np.int32))
+    return paths
+
+
+class MeshCache:
+    """LRU cache of read-only shapes keyed by (shape kind, segments)
+
+    Shapes are evicted least recently used first once their total size goes
+    over `max_bytes`. If `cache_dir` is given, generated shapes are also
+    stored there as mesh files and loaded back instead of being regenerated.
+    Loaded shapes are memory mapped, so app instances using the same cache
+    directory share the memory of their shapes.
+    """
+    FORMAT_VERSION = 6
+
+    def __init__(self, max_bytes=32 * 2**20, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = None if cache_dir is None else Path(cache_dir)
+        self.nbytes = 0
+        self._shapes = OrderedDict()
+
+    def get(self, kind, segments):
+        key = (kind, int(segments))
+        shape = self._shapes.get(key)
+        if shape is not None:
+            self._shapes.move_to_end(key)
+            return shape
+        shape = self._load(key)
+        if shape is None:
+            shape = self._store(key, SHAPES[kind](key[1]))
+        self._shapes[key] = shape
+        self.nbytes += _shape_nbytes(shape)
+        while self.nbytes > self.max_bytes and len(self._shapes) > 1:
+            _, evicted = self._shapes.popitem(last=False)
+            self.nbytes -= _shape_nbytes(evicted)
+        return shape
+
+    def levels(self, kind, segments, min_segments=3):
+        """Get a shape at decreasing levels of detail
+
+        Returns (segments, shape) pairs, halving the segments from `segments`
+        down to no less than `min_segments`.
+        """
+        segments = int(segments)
+        levels = [(segments, self.get(kind, segments))]
+        while segments // 2 >= min_segments:
+            segments //= 2
+            levels.append((segments, self.get(kind, segments)))
+        return levels
+
+    def get_file(self, path, loader):
+        """Get a shape loaded out of a mesh file by `loader`
+
+        The shape goes through the disk cache, keyed by the file path, size
+        and modification time, but not through the in memory cache. This
+        leaves the cache state alone, so it can be called from other threads.
+        """
+        path = Path(path).resolve()
+        stat = path.stat()
+        key = ('file', hashlib.sha1('{}:{}:{}'.format(
+            path, stat.st_size, stat.st_mtime_ns
+        ).encode('utf-8')).hexdigest())
+        shape = self._load(key)
+        if shape is None:
+            shape = self._store(key, loader(path))
         return shape
 
-    def add_vertices(self, vertices):
-        self.vertices = np.concatenate((self.vertices, vertices))
+    def clear(self):
+        self._shapes.clear()
+        self.nbytes = 0
+
+    def _path(self, key):
+        return self.cache_dir / '{}-{}.v{}.mesh'.format(
+            key[0], key[1], self.FORMAT_VERSION
+        )
+
+    def _store(self, key, shape):
+        """Save a new shape to the disk cache, and get it back mapped from
+        there if that worked, or as a read-only copy if not"""
+        self._save(key, shape)
+        return self._load(key) or _read_only(shape)
 
-    def add_faces(self, faces):
-        self.faces.extend(faces)
+    def _load(self, key):
+        if self.cache_dir is None:
+            return None
+        try:
+            arrays = meshfile.load(self._path(key))
+            return Shape(
+                arrays['vertices'],
+                Faces(arrays['face_indices'], arrays['face_offsets']),
+                arrays['normals'],
+                arrays['centroids'],
+                arrays['edges'],
+                Adjacency(
+                    arrays['adjacency_offsets'], arrays['adjacency_edges']
+                ),
+            )
+        except (OSError, KeyError, ValueError):
+            return None
 
-    def add_edges(self, edges):
-        self.edges.extend(edges)
+    def _save(self, key, shape):
+        if self.cache_dir is None:
+            return
+        path = self._path(key)
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            # Other app instances may be saving the same shape at the same
+            # time, so each writes its own file and then swaps it in. Files
+            # already mapped by others stay intact, as the swap only unlinks
+            # them.
+            fd, tmp_path = tempfile.mkstemp(
+                dir=self.cache_dir, prefix=path.stem + '.', suffix='.tmp'
+            )
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    meshfile.save(f, [
+                        ('vertices', shape.vertices),
+                        ('face_indices', shape.faces.indices),
+                        ('face_offsets', shape.faces.offsets),
+                        ('normals', shape.normals),
+                        ('centroids', shape.centroids),
+                        ('edges', shape.edges),
+                        ('adjacency_offsets', shape.adjacency.offsets),
+                        ('adjacency_edges', shape.adjacency.edges),
+                    ])
+                os.replace(tmp_path, path)
+            except OSError:
+                os.unlink(tmp_path)
+                raise
+        except OSError:
+            # The disk cache is an optimization, failing to write it is not
+            # an error
+            pass
 
 
+def _read_only(shape):
+    def frozen(a):
+        if isinstance(a, Faces):
+            return a.read_only()
+        if isinstance(a, tuple):
+            return type(a)(*(frozen(b) for b in a))
+        a = np.array(a)
+        a.setflags(write=False)
+        return a
+    return frozen(shape)
+
+def _shape_nbytes(shape):
+    if isinstance(shape, tuple):
+        return sum(_shape_nbytes(a) for a in shape)
+    return shape.nbytes
+
+def _repeat_offsets(offsets, copies):
+    """Repeat CSR offsets for copies of the data they index"""
+    repeated = np.empty(len(copies) * (len(offsets) - 1) + 1, dtype=np.int32)
+    repeated[:-1] = (offsets[:-1] + copies * offsets[-1]).ravel()
+    repeated[-1] = len(copies) * offsets[-1]
+    return repeated
+
 def _polygon_face(segments, vtx_st_i, flip_direction=False):
-    face = range(vtx_st_i, vtx_st_i+segments)
+    face = np.arange(vtx_st_i, vtx_st_i+segments)
     if flip_direction:
-        face = reversed(face)
-    return list(face)
+        face = face[::-1]
+    return face[None, :]
+
+def _ring(segments, vtx_st_i):
+    """Indices of the vertices in a polygon ring, and of the ones next to
+    them"""
+    n = np.arange(segments)
+    return vtx_st_i + n, vtx_st_i + (n+1) % segments
 
 def _polygon_edges(segments, vtx_st_i, poly_face_i, side_face_st_i):
-    return [[
-        vtx_st_i+n, vtx_st_i+(n+1)%segments,
-        poly_face_i, side_face_st_i+n
-    ] for n in range(segments)]
+    vtx, next_vtx = _ring(segments, vtx_st_i)
+    return np.stack((
+        vtx, next_vtx,
+        np.full(segments, poly_face_i), side_face_st_i + np.arange(segments),
+    ), axis=1)
 
 def _rim_edges(segments, vtx_st_i, bottom_face_st_i, top_face_st_i):
-    return [[
-        vtx_st_i+n, vtx_st_i+(n+1)%segments,
-        bottom_face_st_i+n, top_face_st_i+n
-    ] for n in range(segments)]
+    vtx, next_vtx = _ring(segments, vtx_st_i)
+    n = np.arange(segments)
+    return np.stack((
+        vtx, next_vtx,
+        bottom_face_st_i + n, top_face_st_i + n,
+    ), axis=1)
 
 def _cylinder_faces(segments, bottom_vtx_st_i, top_vtx_st_i):
-    return [[
-        bottom_vtx_st_i+n, bottom_vtx_st_i+(n+1)%segments,
-        top_vtx_st_i+(n+1)%segments, top_vtx_st_i+n,
-    ] for n in range(segments)]
+    bottom, next_bottom = _ring(segments, bottom_vtx_st_i)
+    top, next_top = _ring(segments, top_vtx_st_i)
+    return np.stack((bottom, next_bottom, next_top, top), axis=1)
 
 def _cylinder_edges(segments, bottom_vtx_st_i, top_vtx_st_i, face_st_i):
-    return [[
-        bottom_vtx_st_i+n, top_vtx_st_i+n,
-        face_st_i+(n-1) % segments, face_st_i+n
-    ] for n in range(segments)]
+    n = np.arange(segments)
+    return np.stack((
+        bottom_vtx_st_i + n, top_vtx_st_i + n,
+        face_st_i + (n-1) % segments, face_st_i + n,
+    ), axis=1)
 
 def _cone_faces(segments, edge_vtx_st_i, point_vtx_i, flip_direction=False):
+    vtx, next_vtx = _ring(segments, edge_vtx_st_i)
+    point = np.full(segments, point_vtx_i)
     if flip_direction:
-        return [
-            [edge_vtx_st_i+n, point_vtx_i, edge_vtx_st_i+(n+1)%segments]
-            for n in range(segments)
-        ]
+        return np.stack((vtx, point, next_vtx), axis=1)
     else:
-        return [
-            [edge_vtx_st_i+n, edge_vtx_st_i+(n+1)%segments, point_vtx_i]
-            for n in range(segments)
-        ]
+        return np.stack((vtx, next_vtx, point), axis=1)
 
 def _cone_edges(segments, edge_vtx_st_i, point_vtx_i, faces_st_i):
-    return [[
-        edge_vtx_st_i+n, point_vtx_i,
-        faces_st_i+(n-1) % segments, faces_st_i+n
-    ] for n in range(segments)]
+    n = np.arange(segments)
+    return np.stack((
+        edge_vtx_st_i + n, np.full(segments, point_vtx_i),
+        faces_st_i + (n-1) % segments, faces_st_i + n,
+    ), axis=1)
+
+# Shape of the index block returned by each face function, given the amount
+# of segments
+_FACE_BLOCKS = {
+    _polygon_face: lambda segments: (1, segments),
+    _cylinder_faces: lambda segments: (segments, 4),
+    _cone_faces: lambda segments: (segments, 3),
+}
@@ -0,0 +1,137 @@
+"""profiler.py - per-frame timing of the render pipeline stages
+"""
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+from time import perf_counter
+import csv
+import json
+import numpy as np
+
+STAGES = [
+    'transform', 'culling', 'shading', 'outline', 'depth_sort',
+    'face_draw', 'edge_draw', 'gtk_draw',
+]
+PERCENTILES = (50, 95, 99)
+
+class FrameRecord:
+    """Stage timings of a single frame
+
+    Records are handed along with the frame they belong to, so stages run on
+    other threads, or finishing after the next frame began, are recorded
+    into the right frame.
+    """
+    def __init__(self, timings=None):
+        self.timings = timings
+
+    @contextmanager
+    def stage(self, name):
+        if self.timings is None:
+            yield
+            return
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, perf_counter() - start)
+
+    def record(self, name, seconds):
+        if self.timings is None:
+            return
+        self.timings[name] = self.timings.get(name, 0.) + seconds
+
+NULL_RECORD = FrameRecord()
+
+class FrameProfiler:
+    """Record how long each render pipeline stage takes in every frame
+
+    Timings of the last `window` frames are kept so rolling percentiles can
+    be shown while the app runs, and dumped as a JSON or CSV trace.
+    """
+    def __init__(self, window=300, enabled=True):
+        self.enabled = enabled
+        self.frames = deque(maxlen=window)
+        self._current = None
+
+    def begin_frame(self):
+        """Start recording a new frame, returning its `FrameRecord`
+
+        Stages of the frame can be recorded through the profiler until the
+        next frame begins, or through the record at any time, which is what
+        stages finishing asynchronously (like GTK drawing the frame) need.
+        """
+        if not self.enabled:
+            return NULL_RECORD
+        self._current = FrameRecord(dict())
+        self.frames.append(self._current.timings)
+        return self._current
+
+    def stage(self, name):
+        if not self.enabled or self._current is None:
+            return NULL_RECORD.stage(name)
+        return self._current.stage(name)
+
+    def record(self, name, seconds):
+        if self.enabled and self._current is not None:
+            self._current.record(name, seconds)
+
+    def percentiles(self, name):
+        """Get the rolling percentiles of a stage, in milliseconds"""
+        timings = [frame[name] for frame in self.frames if name in frame]
+        if not timings:
+            return None
+        return np.percentile(timings, PERCENTILES) * 1000.
+
+    def summary(self):
+        summary = dict()
+        for name in self._stages():
+            summary[name] = {
+                'p{}'.format(p): t
+                for p, t in zip(PERCENTILES, self.percentiles(name).tolist())
+            }
+        return summary
+
+    def overlay_lines(self):
+        lines = ['{:<10}'.format('ms') + ''.join(
+            '{:>7}'.format('p{}'.format(p)) for p in PERCENTILES
+        )]
+        for name in self._stages():
+            lines.append('{:<10}'.format(name) + ''.join(
+                '{:>7.2f}'.format(t) for t in self.percentiles(name)
+            ))
+        return lines
+
+    def dump(self, path):
+        """Write the recorded frames to a CSV or a JSON file
+
+        The format is picked by the file suffix, timings are in milliseconds.
+        """
+        path = Path(path)
+        stages = self._stages()
+        frames = [
+            {name: frame[name] * 1000. for name in stages if name in frame}
+            for frame in self.frames
+        ]
+        if path.suffix.lower() == '.csv':
+            with open(path, 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=['frame'] + stages)
+                writer.writeheader()
+                for i, frame in enumerate(frames):
+                    writer.writerow(dict(frame, frame=i))
+        else:
+            with open(path, 'w') as f:
+                json.dump({
+                    'stages': stages,
+                    'summary': self.summary(),
+                    'frames': frames,
+                }, f, indent=1)
+
+    def _stages(self):
+        """Recorded stage names, in pipeline order"""
+        recorded = set()
+        for frame in self.frames:
+            recorded.update(frame)
+        return [name for name in STAGES if name in recorded] + \
+            sorted(recorded.difference(STAGES))
+
+NULL_PROFILER = FrameProfiler(enabled=False)
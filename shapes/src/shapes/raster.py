@@ -0,0 +1,142 @@
+"""raster.py - numpy-based software rasterizer
+"""
+import numpy as np
+from math import floor, ceil
+import struct
+import zlib
+
+from .renderer import RenderTarget, BACKGROUND_COLOR, LINE_COLOR
+
+# The opaque background color as a pixel packed into a native uint32
+BACKGROUND_PIXEL = np.array(BACKGROUND_COLOR + (255,), dtype=np.uint8) \
+    .view(np.uint32)[0]
+
+class Framebuffer(RenderTarget):
+    """Render target drawing frames into an RGBA `ndarray`
+
+    `pixels` is a preallocated (height, width, 4) uint8 array that is only
+    reallocated when a frame of a different size is drawn.
+    """
+    def __init__(self, width, height):
+        self.pixels = np.empty((height, width, 4), dtype=np.uint8)
+
+    @classmethod
+    def wrap(cls, pixels):
+        """Make a framebuffer drawing into an existing (height, width, 4)
+        uint8 array, like a view of a part of a larger image"""
+        framebuffer = cls.__new__(cls)
+        framebuffer.pixels = pixels
+        return framebuffer
+
+    @property
+    def width(self):
+        return self.pixels.shape[1]
+
+    @property
+    def height(self):
+        return self.pixels.shape[0]
+
+    def clear(self, width, height):
+        width, height = int(width), int(height)
+        if (width, height) != (self.width, self.height):
+            self.pixels = np.empty((height, width, 4), dtype=np.uint8)
+        # One store per pixel rather than a strided one per channel
+        self.pixels.view(np.uint32).fill(BACKGROUND_PIXEL)
+
+    def fill_faces(self, points, faces, colors):
+        for f, color in zip(faces, colors):
+            self.fill_polygon(points[f], color)
+
+    def stroke_paths(self, points, paths, line_width):
+        for path in paths:
+            path_points = points[path]
+            for p0, p1 in zip(path_points[:-1], path_points[1:]):
+                self.stroke_segment(p0, p1, line_width, LINE_COLOR)
+
+    def fill_polygon(self, points, color):
+        """Scanline fill a polygon using the even-odd rule
+
+        A pixel is covered when its center is inside the polygon. All the
+        scanlines in the polygon bounding box are processed at once: edge
+        crossings toggle a per-row counter that is then accumulated along the
+        row.
+        """
+        x_st, x_end, y_st, y_end = self._bounds(points, 0)
+        if x_st >= x_end or y_st >= y_end:
+            return
+
+        x0, y0 = points[:, 0], points[:, 1]
+        x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+        ys = np.arange(y_st, y_end)[:, None] + 0.5
+        # Half-open crossing test, so horizontal edges and shared vertices
+        # are never counted twice
+        rows, edges = np.nonzero((y0 <= ys) != (y1 <= ys))
+        xs = x0[edges] + \
+            (ys[rows, 0] - y0[edges]) * (x1[edges] - x0[edges]) / \
+            (y1[edges] - y0[edges])
+        cols = np.clip(np.ceil(xs - 0.5) - x_st, 0, x_end - x_st)
+
+        row_width = x_end - x_st + 1
+        toggles = np.bincount(
+            rows * row_width + cols.astype(int),
+            minlength=(y_end - y_st) * row_width
+        ).reshape(y_end - y_st, row_width)
+        inside = np.cumsum(toggles, axis=1)[:, :-1] % 2 == 1
+        self.pixels[y_st:y_end, x_st:x_end, :3][inside] = color
+
+    def stroke_segment(self, p0, p1, line_width, color):
+        """Draw a line segment with round caps"""
+        radius = line_width / 2
+        x_st, x_end, y_st, y_end = self._bounds(np.array((p0, p1)), radius)
+        if x_st >= x_end or y_st >= y_end:
+            return
+
+        px = np.arange(x_st, x_end) + 0.5 - p0[0]
+        py = np.arange(y_st, y_end)[:, None] + 0.5 - p0[1]
+        dx, dy = p1[0] - p0[0], p1[1] - p0[1]
+        length2 = dx * dx + dy * dy
+        if length2 > 0:
+            t = np.clip((px * dx + py * dy) / length2, 0, 1)
+        else:
+            t = 0
+        inside = (px - t * dx)**2 + (py - t * dy)**2 <= radius * radius
+        self.pixels[y_st:y_end, x_st:x_end, :3][inside] = color
+
+    def _bounds(self, points, margin):
+        return (
+            max(floor(points[:, 0].min() - margin), 0),
+            min(ceil(points[:, 0].max() + margin), self.width),
+            max(floor(points[:, 1].min() - margin), 0),
+            min(ceil(points[:, 1].max() + margin), self.height),
+        )
+
+
+def write_png(path, pixels, compression=6, band_rows=256):
+    """Write an (height, width, 4) uint8 RGBA array as a PNG file
+
+    The image is compressed in bands of rows, so large images do not need a
+    whole second copy in memory.
+    """
+    height, width = pixels.shape[:2]
+    compressor = zlib.compressobj(compression)
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        _write_chunk(f, b'IHDR', struct.pack(
+            '>IIBBBBB', width, height, 8, 6, 0, 0, 0
+        ))
+        data = []
+        # Every row starts with its filter type, 0 for none
+        rows = np.zeros((band_rows, width * 4 + 1), dtype=np.uint8)
+        for y in range(0, height, band_rows):
+            band = pixels[y:y + band_rows]
+            rows[:len(band), 1:] = band.reshape(len(band), width * 4)
+            data.append(compressor.compress(rows[:len(band)].tobytes()))
+        data.append(compressor.flush())
+        _write_chunk(f, b'IDAT', b''.join(data))
+        _write_chunk(f, b'IEND', b'')
+
+def _write_chunk(f, kind, data):
+    f.write(struct.pack('>I', len(data)))
+    f.write(kind)
+    f.write(data)
+    f.write(struct.pack('>I', zlib.crc32(kind + data)))
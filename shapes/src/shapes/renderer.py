@@ -0,0 +1,529 @@
+"""renderer.py - toolkit independent frame preparation and render targets
+"""
+from collections import namedtuple
+import numpy as np
+from travertino.colors import rgb
+
+from . import transforms as tr
+from . import models
+from .profiler import NULL_PROFILER
+
+Frame = namedtuple('Frame', [
+    'width', 'height', 'points', 'faces', 'colors', 'paths', 'line_width',
+    'path_positions',
+])
+
+BACKGROUND_COLOR = (255, 255, 255)
+LINE_COLOR = (0, 0, 0)
+EDGE_PERCENT = 0.8
+LIGHT_VECTOR = (np.array([1., 1., -1.]) / np.sqrt(3)).astype(np.float32)
+
+def prepare_frame(
+    shape, pipeline, base_color, profiler=NULL_PROFILER, arena=None
+):
+    """Turn a shape into a screen-space `Frame` using a `tr.Pipeline`
+
+    `points` are the (x, y) screen coordinates of the shape vertices, `faces`
+    and `colors` are the visible faces and their shading, and `paths` are
+    `models.Faces` of vertex indices tracing the shape outline. Closed paths
+    end with the vertex they start with. `path_positions` are the amounts of
+    faces to draw before each path, see `frame_layers`.
+
+    Scratch and frame arrays are taken from `arena` if one is given, so the
+    frame is only valid until the next one is prepared with it.
+    """
+    if arena is None:
+        arena = tr.Arena()
+    n_faces = len(shape.faces)
+    with profiler.stage('transform'):
+        # The shape carries unit face normals, which rotation keeps unit
+        normals = np.matmul(
+            shape.normals, pipeline.rotation[:3, :3],
+            out=arena.get('normals', (n_faces, 3))
+        )
+        # View space face centers, to check which way the faces are facing
+        # relative to the camera
+        centroids = np.matmul(
+            shape.centroids, pipeline.world,
+            out=arena.get('centroids', (n_faces, 4))
+        )
+        vertices = pipeline.project(
+            shape.vertices, out=arena.get('screen', (len(shape.vertices), 4))
+        )
+
+    with profiler.stage('culling'):
+        visible = tr.visible_faces(
+            normals, centroids, out=arena.get('visible', (n_faces,), bool)
+        )
+        faces = shape.faces[visible]
+        silhouette = tr.silhouette_edges(
+            shape.edges, visible,
+            out=arena.get('silhouette', (len(shape.edges),), bool)
+        )
+
+    with profiler.stage('shading'):
+        n_visible = len(faces)
+        normals = np.compress(
+            visible, normals, axis=0,
+            out=arena.get('visible_normals', (n_visible, 3))
+        )
+        light_cos = np.matmul(
+            normals, LIGHT_VECTOR, out=arena.get('light_cos', (n_visible,))
+        )
+        colors = shade(
+            light_cos, base_color,
+            out=arena.get('colors', (n_visible, 3), np.uint8)
+        )
+
+    with profiler.stage('outline'):
+        paths = models.Faces.from_lists(
+            models.edge_loops(shape.adjacency, shape.edges, silhouette)
+        )
+
+    return Frame(
+        width=pipeline.width,
+        height=pipeline.height,
+        points=vertices[:, 0:3:2],
+        faces=faces,
+        colors=colors,
+        paths=paths,
+        line_width=max(pipeline.width*0.01, 4.0),
+        path_positions=np.full(len(paths), len(faces), dtype=np.int32),
+    )
+
+def prepare_scene(
+    scene, pipeline, profiler=NULL_PROFILER, arena=None, shapes=None
+):
+    """Turn all the objects of a `Scene` into a single screen-space `Frame`
+
+    Objects drawn with the same shape are processed together as one batch of
+    instances, transformed with one batched matrix product, so the cost of a
+    frame follows the amount of distinct shapes rather than of objects. The
+    visible faces of all the objects are sorted back to front by the view
+    space depth of their centers, so overlapping objects and non-convex shapes
+    are drawn right (painter's algorithm) as long as faces do not intersect.
+
+    The outlines take part in the painter's algorithm too: they are made of
+    single edge paths, each drawn right after the faces around its ends so
+    that nearer faces still cover it. On convex shapes, which can not cover
+    their own outlines, they are kept after the following faces of the same
+    object too, which could otherwise reach over half of their stroke.
+
+    Like with `prepare_frame`, arrays are taken from `arena` if given.
+    `shapes` are the shapes to draw the objects with, as returned by
+    `Scene.select_levels`, and default to the object shapes.
+    """
+    if arena is None:
+        arena = tr.Arena()
+    if shapes is None:
+        shapes = [obj.shape for obj in scene]
+    points, faces, colors, depths, segments = [], [], [], [], []
+    vertex_offsets, counts, sizes, convex = [], [], [], []
+    n_points = 0
+    for i, (shape, objects) in enumerate(_batches(scene, shapes)):
+        n_vertices, n_faces = len(shape.vertices), len(shape.faces)
+        if len(objects) == 1:
+            obj, = objects
+            batch_faces, edges, _ = obj.topology(shape)
+            transforms, base_colors = obj.transforms, obj.colors
+        else:
+            transforms = np.concatenate([obj.transforms for obj in objects])
+            base_colors = np.concatenate([obj.colors for obj in objects])
+            batch_faces, edges, _ = \
+                models.repeat_topology(shape, len(transforms))
+        count = len(transforms)
+        with profiler.stage('transform'):
+            model = transforms[:, :3, :3]
+            # Normals transform by the inverse transpose of the model matrix.
+            # Rescaled by the model scale that keeps them unit length, unless
+            # the model scales unevenly.
+            normal_matrices = np.linalg.inv(model).transpose(0, 2, 1) \
+                * np.cbrt(np.abs(np.linalg.det(model)))[:, None, None]
+            unit = np.allclose(
+                normal_matrices @ normal_matrices.transpose(0, 2, 1),
+                np.identity(3), atol=1e-4
+            )
+            normal_matrices = normal_matrices @ pipeline.rotation[:3, :3]
+            normals = np.matmul(
+                shape.normals, normal_matrices,
+                out=arena.get(('normals', i), (count, n_faces, 3))
+            ).reshape(-1, 3)
+            world = transforms @ pipeline.world
+            centroids = np.matmul(
+                shape.centroids, world,
+                out=arena.get(('centroids', i), (count, n_faces, 4))
+            ).reshape(-1, 4)
+            view = np.matmul(
+                shape.vertices, world,
+                out=arena.get(('view', i), (count, n_vertices, 4))
+            ).reshape(-1, 4)
+            screen = np.matmul(
+                view, pipeline.screen,
+                out=arena.get(('screen', i), (len(view), 4))
+            )
+            np.divide(screen[:, :3], screen[:, 3:], out=screen[:, :3])
+
+        with profiler.stage('culling'):
+            visible = tr.visible_faces(
+                normals, centroids,
+                out=arena.get(('visible', i), (len(normals),), bool)
+            )
+            batch_faces = batch_faces[visible]
+            silhouette = tr.silhouette_edges(
+                edges, visible,
+                out=arena.get(('silhouette', i), (len(edges),), bool)
+            )
+            # The camera looks along the Y axis
+            depths.append(np.compress(visible, centroids[:, 1]))
+
+        with profiler.stage('shading'):
+            instance = np.flatnonzero(visible) // n_faces
+            face_colors = base_colors[instance]
+            normals = np.compress(visible, normals, axis=0)
+            light_cos = normals @ LIGHT_VECTOR
+            if not unit:
+                light_cos /= np.linalg.norm(normals, axis=1)
+            colors.append(shade(light_cos, face_colors))
+
+        with profiler.stage('outline'):
+            segments.append(
+                np.compress(silhouette, edges[:, :2], axis=0) + n_points
+            )
+
+        points.append(screen[:, 0:3:2])
+        faces.append(batch_faces)
+        vertex_offsets.append(n_points)
+        n_points += len(screen)
+        counts.append(count)
+        sizes.append(n_vertices)
+        convex.append(objects[0].convex(shape))
+
+    with profiler.stage('depth_sort'):
+        faces = models.Faces.concatenate(faces, vertex_offsets)
+        sorted_colors = arena.get('colors', (len(faces), 3), np.uint8)
+        if depths:
+            order = np.argsort(-np.concatenate(depths), kind='stable')
+            faces = faces[order]
+            np.take(np.concatenate(colors), order, axis=0, out=sorted_colors)
+
+    with profiler.stage('outline'):
+        if segments:
+            segments = np.concatenate(segments)
+        else:
+            segments = np.empty((0, 2), dtype=np.int32)
+        # The instance each point belongs to, and if its shape is convex
+        instances = np.repeat(
+            np.arange(sum(counts), dtype=np.int32),
+            np.repeat(np.array(sizes, dtype=np.int32), counts),
+        )
+        convex = np.repeat(np.array(convex, dtype=bool), counts)
+        positions = _segment_positions(faces, segments, instances, convex)
+        order = np.argsort(positions, kind='stable')
+        paths = models.Faces(
+            segments[order].ravel(), np.arange(0, len(segments) * 2 + 1, 2)
+        )
+
+    frame_points = arena.get('points', (n_points, 2))
+    if points:
+        np.concatenate(points, out=frame_points)
+
+    return Frame(
+        width=pipeline.width,
+        height=pipeline.height,
+        points=frame_points,
+        faces=faces,
+        colors=sorted_colors,
+        paths=paths,
+        line_width=max(pipeline.width*0.01, 4.0),
+        path_positions=positions[order],
+    )
+
+def frame_layers(frame):
+    """Split a frame into the layers of (faces, colors, paths) to draw in turn
+
+    Each layer draws its faces and then its paths, so every path goes right
+    after the amount of faces given by its entry in `path_positions`, which
+    must not decrease from one path to the next.
+    """
+    faces, colors, paths = frame.faces, frame.colors, frame.paths
+    positions = np.asarray(frame.path_positions)
+    starts = np.flatnonzero(np.diff(positions, prepend=-1)).tolist()
+    ends = starts[1:] + [len(positions)]
+    face_start = 0
+    for start, end in zip(starts, ends):
+        face_end = int(positions[start])
+        yield (
+            faces[face_start:face_end], colors[face_start:face_end],
+            paths[start:end],
+        )
+        face_start = face_end
+    if face_start < len(faces) or not starts:
+        yield faces[face_start:], colors[face_start:], paths[0:0]
+
+def shade(light_cos, base_color, out=None):
+    """Shade faces given the cosines of their angles to the light
+
+    Returns an (N, 3) uint8 array of colors, ramping from `base_color`
+    darkened for faces lit head-on to white for faces pointing away from the
+    light. `base_color` can also be an (N, 3) array with a color per face.
+    """
+    light_cos = np.asarray(light_cos, dtype=np.float32)[:, None]
+    if isinstance(base_color, np.ndarray):
+        base = base_color.astype(np.float32)
+    else:
+        base = np.array(
+            [base_color.r, base_color.g, base_color.b], dtype=np.float32
+        )
+    factor = (1 - np.abs(light_cos)) * EDGE_PERCENT + (1. - EDGE_PERCENT)
+    white = np.where(light_cos > 0, 0., 255 * (1 - factor))
+    colors = base * factor + white
+    if out is None:
+        return colors.astype(np.uint8)
+    np.copyto(out, colors, casting='unsafe')
+    return out
+
+def color_ramp(base_color, ang_cos):
+    return tuple(int(c) for c in shade([ang_cos], base_color)[0])
+
+class RenderTarget:
+    """Base class for surfaces a `Frame` can be drawn onto
+
+    Subclasses implement the `clear`, `fill_faces` and `stroke_paths` drawing
+    primitives, `draw` issues them in order for a whole frame, a layer of
+    faces and paths after the other.
+    """
+    def draw(self, frame, profiler=NULL_PROFILER):
+        self.clear(frame.width, frame.height)
+        for faces, colors, paths in frame_layers(frame):
+            with profiler.stage('face_draw'):
+                self.fill_faces(frame.points, faces, colors)
+            with profiler.stage('edge_draw'):
+                self.stroke_paths(frame.points, paths, frame.line_width)
+
+    def draw_overlay(self, lines):
+        """Write lines of text over the frame, if the target can draw text"""
+        pass
+
+    def clear(self, width, height):
+        raise NotImplementedError()
+
+    def fill_faces(self, points, faces, colors):
+        raise NotImplementedError()
+
+    def stroke_paths(self, points, paths, line_width):
+        raise NotImplementedError()
+
+
+class CanvasTarget(RenderTarget):
+    """Draw frames by building the drawing object tree of a Toga `Canvas`"""
+    def __init__(self, canvas, overlay_font=None):
+        self.canvas = canvas
+        self.overlay_font = overlay_font
+        self._colors = dict()
+
+    def color(self, packed):
+        """Get a (cached) `rgb` object for a 0xRRGGBB packed color"""
+        try:
+            return self._colors[packed]
+        except KeyError:
+            color = rgb(packed >> 16, (packed >> 8) & 0xff, packed & 0xff)
+            self._colors[packed] = color
+            return color
+
+    def clear(self, width, height):
+        self.canvas.clear()
+        with self.canvas.fill(color=rgb(*BACKGROUND_COLOR)) as fill:
+            fill.rect(x=0, y=0, width=width, height=height)
+
+    def fill_faces(self, points, faces, colors):
+        packed = colors.astype(np.int32) @ np.array([0x10000, 0x100, 1])
+        packed = packed.tolist()
+        for f, color in zip(faces, packed):
+            with self.canvas.fill(color=self.color(color)) as fill:
+                with fill.closed_path(*points[f[0]]) as polygon:
+                    for v in f[1:]:
+                        polygon.line_to(*points[v])
+
+    def stroke_paths(self, points, paths, line_width):
+        if not paths:
+            return
+        with self.canvas.stroke(
+            color=rgb(*LINE_COLOR), line_width=line_width
+        ) as stroke:
+            for path in paths:
+                if path[0] == path[-1]:
+                    with stroke.closed_path(*points[path[0]]) as line:
+                        for v in path[1:-1]:
+                            line.line_to(*points[v])
+                else:
+                    stroke.move_to(*points[path[0]])
+                    for v in path[1:]:
+                        stroke.line_to(*points[v])
+
+    def draw_overlay(self, lines):
+        with self.canvas.fill(color=rgb(*LINE_COLOR)) as fill:
+            fill.write_text('\n'.join(lines), 5, 15, self.overlay_font)
+
+
+class RetainedCanvasTarget(CanvasTarget):
+    """Draw frames into a Toga `Canvas` reusing its drawing objects
+
+    Instead of rebuilding the drawing object tree every frame, the polygon and
+    path objects are kept in pools by vertex count and only get their
+    coordinates and colors updated in place. New objects are only created
+    when a frame needs more of them than any frame drawn before it, which
+    normally means once per mesh topology.
+    """
+    def __init__(self, canvas, overlay_font=None):
+        super().__init__(canvas, overlay_font)
+        self._background = None
+        self._strokes = []
+        self._stroke = None
+        # vertex count -> [(fill, closed_path, line_tos), ...]
+        self._polygons = dict()
+        # vertex count -> [(closed_path, line_tos), ...]
+        self._loops = dict()
+        # vertex count -> [(move_to, line_tos), ...]
+        self._lines = dict()
+        self._objects = []
+        self._new_frame()
+
+    def draw(self, frame, profiler=NULL_PROFILER):
+        self._objects = []
+        self._new_frame()
+        super().draw(frame, profiler)
+        self.canvas.drawing_objects[:] = self._objects
+
+    def _new_frame(self):
+        # Pooled objects used so far in the frame, by vertex count
+        self._used_polygons = dict()
+        self._used_loops = dict()
+        self._used_lines = dict()
+        self._used_strokes = 0
+
+    def clear(self, width, height):
+        if self._background is None:
+            with self.canvas.fill(color=rgb(*BACKGROUND_COLOR)) as fill:
+                rect = fill.rect(x=0, y=0, width=width, height=height)
+            self._background = fill, rect
+        fill, rect = self._background
+        rect.width, rect.height = width, height
+        self._objects.append(fill)
+
+    def fill_faces(self, points, faces, colors):
+        packed = colors.astype(np.int32) @ np.array([0x10000, 0x100, 1])
+        packed = packed.tolist()
+        points = points.tolist()
+        indices = faces.indices.tolist()
+        offsets = faces.offsets.tolist()
+        for start, end, color in zip(offsets[:-1], offsets[1:], packed):
+            size = end - start
+            fill, polygon, line_tos = self._take(
+                self._polygons, self._used_polygons, size, self._new_polygon
+            )
+            fill.color = self.color(color)
+            polygon.x, polygon.y = points[indices[start]]
+            for line_to, v in zip(line_tos, indices[start + 1:end]):
+                line_to.x, line_to.y = points[v]
+            self._objects.append(fill)
+
+    def stroke_paths(self, points, paths, line_width):
+        if not paths:
+            return
+        if self._used_strokes == len(self._strokes):
+            with self.canvas.stroke(color=rgb(*LINE_COLOR)) as stroke:
+                self._strokes.append(stroke)
+        self._stroke = self._strokes[self._used_strokes]
+        self._used_strokes += 1
+        self._stroke.line_width = line_width
+        points = points.tolist()
+        objects = []
+        for path in paths:
+            path = path.tolist()
+            if path[0] == path[-1]:
+                path = path[:-1]
+                start, line_tos = self._take(
+                    self._loops, self._used_loops, len(path), self._new_loop
+                )
+                objects.append(start)
+            else:
+                start, line_tos = self._take(
+                    self._lines, self._used_lines, len(path), self._new_line
+                )
+                objects.append(start)
+                objects.extend(line_tos)
+            start.x, start.y = points[path[0]]
+            for line_to, v in zip(line_tos, path[1:]):
+                line_to.x, line_to.y = points[v]
+        self._stroke.drawing_objects[:] = objects
+        self._objects.append(self._stroke)
+
+    @staticmethod
+    def _take(pool, used, size, new):
+        """Get the next unused pooled object set for `size` vertices"""
+        objects = pool.setdefault(size, [])
+        i = used.get(size, 0)
+        used[size] = i + 1
+        if i == len(objects):
+            objects.append(new(size))
+        return objects[i]
+
+    def _new_polygon(self, size):
+        with self.canvas.fill() as fill:
+            with fill.closed_path(0, 0) as polygon:
+                line_tos = [polygon.line_to(0, 0) for _ in range(size - 1)]
+        return fill, polygon, line_tos
+
+    def _new_loop(self, size):
+        with self._stroke.closed_path(0, 0) as line:
+            line_tos = [line.line_to(0, 0) for _ in range(size - 1)]
+        return line, line_tos
+
+    def _new_line(self, size):
+        move_to = self._stroke.move_to(0, 0)
+        line_tos = [self._stroke.line_to(0, 0) for _ in range(size - 1)]
+        return move_to, line_tos
+
+
+def _batches(scene, shapes):
+    """Group the objects of a scene by the shape they are drawn with
+
+    Returns (shape, objects) pairs in the order the shapes first show up.
+    """
+    batches = dict()
+    for obj, shape in zip(scene, shapes):
+        batches.setdefault(id(shape), (shape, []))[1].append(obj)
+    return list(batches.values())
+
+def _segment_positions(faces, segments, instances, convex):
+    """Get the amount of back to front sorted faces to draw before each
+    (start, end) vertex index segment
+
+    Segments go right after the last drawn of the faces around their ends, so
+    the faces they border never cover them while any nearer face does.
+    `instances` is the object instance of every vertex, and `convex` tells
+    for every instance if its shape is convex. Segments of convex instances
+    go after the whole run of faces of their own instance that follows too,
+    as those can only reach over the stroke and never cover the segment.
+    """
+    face_ranks = np.repeat(
+        np.arange(len(faces), dtype=np.int32), faces.sizes
+    )
+    last_faces = np.full(len(instances), -1, dtype=np.int32)
+    np.maximum.at(last_faces, faces.indices, face_ranks)
+    positions = last_faces[segments].max(axis=1) + 1
+    if not len(segments):
+        return positions
+
+    face_instances = instances[faces.indices[faces.offsets[:-1]]]
+    segment_instances = instances[segments[:, 0]]
+    follow = convex[segment_instances] & (positions < len(faces))
+    follow[follow] = face_instances[positions[follow]] \
+        == segment_instances[follow]
+    run_ends = np.append(
+        np.flatnonzero(np.diff(face_instances)) + 1, len(faces)
+    )
+    positions[follow] = run_ends[
+        np.searchsorted(run_ends, positions[follow], side='right')
+    ]
+    return positions
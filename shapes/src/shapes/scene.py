@@ -0,0 +1,221 @@
+"""scene.py - several shapes placed and drawn together
+"""
+from math import pi
+import numpy as np
+
+from . import models
+
+# Levels of detail are picked so that the segments of shapes are no longer
+# than this on screen, in pixels
+LOD_SEGMENT_PIXELS = 6.
+
+
+class SceneObject:
+    """A shape placed in a scene with a model transform and a base color
+
+    If `levels` is set to (segments, shape) pairs, as returned by
+    `MeshCache.levels`, the scene picks the shape to draw out of them by how
+    large the object shows on screen.
+    """
+    def __init__(self, shape, color, transform=None):
+        self.shape = shape
+        self.color = color
+        self.levels = None
+        if transform is None:
+            transform = np.identity(4, dtype=np.float32)
+        self.transform = np.asarray(transform, dtype=np.float32)
+        # Convexity of shapes by shape id, shared with snapshots
+        self._convex = dict()
+
+    def __len__(self):
+        return 1
+
+    @property
+    def transforms(self):
+        return self.transform[None]
+
+    @property
+    def colors(self):
+        return color_array([self.color])
+
+    def snapshot(self):
+        obj = SceneObject(self.shape, self.color, self.transform.copy())
+        obj.levels = self.levels
+        obj._convex = self._convex
+        return obj
+
+    def topology(self, shape=None):
+        if shape is None:
+            shape = self.shape
+        return shape.faces, shape.edges, shape.adjacency
+
+    def convex(self, shape=None):
+        """Check if the shape is convex, see `models.convex`
+
+        This takes a pass over all the shape edges, so it is only done once
+        per shape.
+        """
+        if shape is None:
+            shape = self.shape
+        return _convex(self._convex, shape, self.levels)
+
+
+class Instances:
+    """Copies of a shape, each with its own model transform and base color
+
+    `transforms` is a (K, 4, 4) array and `colors` a (K, 3) array or a list
+    of colors. All the copies get transformed and culled together in single
+    batched array operations, and share the shape vertex data. Like with
+    `SceneObject`, `levels` can be set to pick the shape by on screen size,
+    the largest copy deciding for all of them.
+    """
+    def __init__(self, shape, transforms, colors):
+        self.shape = shape
+        self.levels = None
+        self.transforms = \
+            np.asarray(transforms, dtype=np.float32).reshape(-1, 4, 4)
+        self.colors = color_array(colors)
+        # Topologies of the copies by shape id, shared with snapshots so the
+        # ones built while preparing frames get reused
+        self._topologies = dict()
+        self._convex = dict()
+
+    def __len__(self):
+        return len(self.transforms)
+
+    def snapshot(self):
+        instances = Instances(
+            self.shape, self.transforms.copy(), self.colors.copy()
+        )
+        instances.levels = self.levels
+        instances._topologies = self._topologies
+        instances._convex = self._convex
+        return instances
+
+    def topology(self, shape=None):
+        """Get the faces, edges and adjacency of all the copies together
+
+        These are only rebuilt when the shape or the amount of copies change.
+        """
+        if shape is None:
+            shape = self.shape
+        cached = self._topologies.get(id(shape))
+        if (
+            cached is None or cached[0] is not shape \
+            or cached[1] != len(self)
+        ):
+            if len(self._topologies) > len(self.levels or ()):
+                self._topologies.clear()
+            cached = (
+                shape, len(self), models.repeat_topology(shape, len(self))
+            )
+            self._topologies[id(shape)] = cached
+        return cached[2]
+
+    def convex(self, shape=None):
+        """Check if the shape is convex, see `SceneObject.convex`"""
+        if shape is None:
+            shape = self.shape
+        return _convex(self._convex, shape, self.levels)
+
+
+class Scene:
+    """Flat scene graph of shapes
+
+    Every object transform maps its shape into the scene, which is then
+    rotated and viewed by the render `Pipeline` like a single shape would be.
+    """
+    def __init__(self):
+        self.objects = []
+
+    def __len__(self):
+        return len(self.objects)
+
+    def __iter__(self):
+        return iter(self.objects)
+
+    def add(self, shape, color, transform=None):
+        obj = SceneObject(shape, color, transform)
+        self.objects.append(obj)
+        return obj
+
+    def add_instances(self, shape, transforms, colors):
+        instances = Instances(shape, transforms, colors)
+        self.objects.append(instances)
+        return instances
+
+    def snapshot(self):
+        """Copy the scene, so a frame can be prepared out of it while the
+        objects keep changing"""
+        scene = Scene()
+        scene.objects = [obj.snapshot() for obj in self.objects]
+        return scene
+
+    def select_levels(self, pipeline):
+        """Pick the shapes to draw the objects with for a view
+
+        Returns a shape per object, picked out of its levels of detail if it
+        has any.
+        """
+        return [
+            pick_level(obj.levels, projected_radius(obj, pipeline))
+            if obj.levels else obj.shape
+            for obj in self.objects
+        ]
+
+    def remove(self, obj):
+        self.objects.remove(obj)
+
+    def clear(self):
+        self.objects.clear()
+
+def color_array(colors):
+    """Convert a list of colors to a (N, 3) uint8 array"""
+    if isinstance(colors, np.ndarray):
+        return colors.astype(np.uint8).reshape(-1, 3)
+    return np.array([(c.r, c.g, c.b) for c in colors], dtype=np.uint8) \
+        .reshape(-1, 3)
+
+def projected_radius(obj, pipeline):
+    """Get the largest on screen radius of the copies of an object, in pixels
+
+    This is an estimate from the distance of the model origins to the camera,
+    and the bounding sphere of the most detailed shape.
+    """
+    vertices = obj.levels[0][1].vertices
+    radius = np.sqrt((vertices[:, :3]**2).sum(axis=1).max())
+    transforms = obj.transforms
+    scales = np.linalg.norm(transforms[:, :3, :3], axis=2).max(axis=1)
+    # The camera looks along the Y axis
+    depths = (transforms[:, 3] @ pipeline.world)[:, 1]
+    if (depths <= radius * scales).any():
+        # Too close to the camera to tell
+        return np.inf
+    return (
+        radius * scales / depths * pipeline.focal_length * pipeline.width / 2
+    ).max()
+
+def pick_level(levels, radius):
+    """Pick the least detailed shape with segments no longer than
+    `LOD_SEGMENT_PIXELS` when shown at `radius` pixels"""
+    wanted = 2 * pi * radius / LOD_SEGMENT_PIXELS
+    shape = levels[0][1]
+    for segments, level_shape in levels:
+        if segments < wanted:
+            break
+        shape = level_shape
+    return shape
+
+
+def _convex(cache, shape, levels):
+    """Look up the convexity of a shape in a cache by shape id, or fill it in
+
+    The cache holds at most one entry per level of detail.
+    """
+    cached = cache.get(id(shape))
+    if cached is None or cached[0] is not shape:
+        if len(cache) > len(levels or ()):
+            cache.clear()
+        cached = (shape, models.convex(shape))
+        cache[id(shape)] = cached
+    return cached[1]
@@ -0,0 +1,64 @@
+"""scheduler.py - fixed frame rate animation scheduling on asyncio
+"""
+import asyncio
+import traceback
+
+class AnimationScheduler:
+    """Call an async frame callback at a target frame rate
+
+    Frames start on a fixed time grid of `1 / fps` second steps. If a frame
+    takes so long that it overruns into the next steps, those steps are
+    skipped rather than rendered late back to back. When the callback returns
+    a false value nothing is left to animate, and the scheduler idles without
+    rendering until `wake()` is called. Exceptions raised by the callback are
+    printed and counted, and also make the scheduler idle, so the next
+    `wake()` starts over rather than finding the scheduler task dead.
+    """
+    def __init__(self, frame_callback, fps=30):
+        self.frame_callback = frame_callback
+        self.fps = fps
+        self.frames = 0
+        self.skipped = 0
+        self.errors = 0
+        self._wake_event = None
+        self._task = None
+
+    def start(self, loop):
+        self._wake_event = asyncio.Event()
+        self._task = loop.create_task(self._run(loop))
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def wake(self):
+        if self._wake_event is not None:
+            self._wake_event.set()
+
+    async def _run(self, loop):
+        next_frame = loop.time()
+        while True:
+            self._wake_event.clear()
+            try:
+                animating = await self.frame_callback()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                traceback.print_exc()
+                self.errors += 1
+                animating = False
+            if not animating:
+                await self._wake_event.wait()
+                next_frame = loop.time()
+                continue
+            self.frames += 1
+
+            frame_time = 1. / self.fps
+            next_frame += frame_time
+            now = loop.time()
+            if now > next_frame:
+                missed = int((now - next_frame) / frame_time) + 1
+                self.skipped += missed
+                next_frame += missed * frame_time
+            await asyncio.sleep(next_frame - now)
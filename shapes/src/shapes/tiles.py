@@ -0,0 +1,216 @@
+"""tiles.py - tiled high resolution rendering over a process pool
+
+Run with `python -m shapes.tiles` to render a single large image of a shape.
+The frame is prepared once and the image split into tiles, which worker
+processes rasterize straight into a framebuffer in shared memory. Each tile
+only gets the faces and outlines reaching into it, and tiles none reach are
+only cleared, without rasterizing.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from math import pi
+from multiprocessing import shared_memory
+import argparse
+import sys
+import numpy as np
+from travertino.colors import color, rgb
+
+from . import transforms as tr
+from . import models
+from . import renderer
+from . import raster
+
+TILE_SIZE = 1024
+
+
+class SharedImage:
+    """An RGBA image in a shared memory block, for processes to draw into
+
+    The process creating the image owns the block, others attach to it by
+    `name`.
+    """
+    def __init__(self, width, height, name=None):
+        self.width = width
+        self.height = height
+        self._owner = name is None
+        if self._owner:
+            self._memory = shared_memory.SharedMemory(
+                create=True, size=width * height * 4
+            )
+        else:
+            self._memory = shared_memory.SharedMemory(name=name)
+        self.name = self._memory.name
+        self.pixels = np.ndarray(
+            (height, width, 4), dtype=np.uint8, buffer=self._memory.buf
+        )
+
+    def close(self):
+        # Views of the buffer must be gone before it can be closed
+        self.pixels = None
+        self._memory.close()
+        if self._owner:
+            self._memory.unlink()
+
+
+def tiles(width, height, tile_size=TILE_SIZE):
+    """Split an image into (x, y, width, height) tiles"""
+    return [
+        (x, y, min(tile_size, width - x), min(tile_size, height - y))
+        for y in range(0, height, tile_size)
+        for x in range(0, width, tile_size)
+    ]
+
+def tile_overlaps(frame, tile_list):
+    """Get which faces and outline paths of a frame reach into which tiles
+
+    Goes by the bounding boxes of the faces and of the outline paths, grown
+    by the line width. Returns a (tiles, faces) and a (tiles, paths) mask.
+    """
+    tile_boxes = np.array(tile_list, dtype=np.float32).reshape(-1, 4)
+    tile_boxes[:, 2:] += tile_boxes[:, :2]
+    return (
+        _overlaps(_boxes(frame.points, frame.faces, 0), tile_boxes),
+        _overlaps(
+            _boxes(frame.points, frame.paths, frame.line_width / 2),
+            tile_boxes,
+        ),
+    )
+
+def tile_frame(frame, tile, faces, paths):
+    """Cut the part of a frame within an (x, y, width, height) tile
+
+    `faces` and `paths` are the sorted indices of the faces and outline paths
+    to keep. The tile frame only has the points these use, moved to the tile
+    origin, and its outline widths still follow the whole frame size.
+    """
+    x, y, width, height = tile
+    tile_faces, tile_paths = frame.faces[faces], frame.paths[paths]
+    used, indices = np.unique(
+        np.concatenate((tile_faces.indices, tile_paths.indices)),
+        return_inverse=True,
+    )
+    n_face_indices = len(tile_faces.indices)
+    return frame._replace(
+        width=width,
+        height=height,
+        points=frame.points[used] - np.array([x, y], dtype=frame.points.dtype),
+        faces=models.Faces(indices[:n_face_indices], tile_faces.offsets),
+        colors=frame.colors[faces],
+        paths=models.Faces(indices[n_face_indices:], tile_paths.offsets),
+        # The kept faces drawn before each path
+        path_positions=np.searchsorted(faces, frame.path_positions[paths]),
+    )
+
+
+class TileRenderer:
+    """Rasterizes frames of tiles into a `SharedImage`"""
+    def __init__(self, image_name, width, height):
+        self.image = SharedImage(width, height, image_name)
+
+    def render(self, tile, frame):
+        x, y, width, height = tile
+        framebuffer = raster.Framebuffer.wrap(
+            self.image.pixels[y:y + height, x:x + width]
+        )
+        framebuffer.draw(frame)
+
+# The tile renderer of a worker process
+_tile_renderer = None
+
+def _init_worker(*args):
+    global _tile_renderer
+    _tile_renderer = TileRenderer(*args)
+
+def _render_tile(job):
+    _tile_renderer.render(*job)
+
+@contextmanager
+def render_tiled(
+    shape, base_color, width, height, x_rotation, z_rotation,
+    tile_size=TILE_SIZE, workers=None,
+):
+    """Render a shape into a large image over a process pool
+
+    `base_color` is an (r, g, b) tuple. Used as a context manager, giving the
+    (height, width, 4) pixels array of the image, which is only valid within
+    the context.
+    """
+    image = SharedImage(width, height)
+    try:
+        pipeline = tr.Pipeline()
+        pipeline.update(x_rotation, z_rotation, width, height)
+        frame = renderer.prepare_frame(shape, pipeline, rgb(*base_color))
+        tile_list = tiles(width, height, tile_size)
+        jobs = []
+        for tile, faces, paths in zip(
+            tile_list, *tile_overlaps(frame, tile_list)
+        ):
+            if faces.any() or paths.any():
+                jobs.append((tile, tile_frame(
+                    frame, tile, np.flatnonzero(faces), np.flatnonzero(paths)
+                )))
+            else:
+                x, y, w, h = tile
+                raster.Framebuffer.wrap(image.pixels[y:y + h, x:x + w]) \
+                    .clear(w, h)
+
+        with ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker,
+            initargs=(image.name, width, height),
+        ) as executor:
+            list(executor.map(_render_tile, jobs))
+        yield image.pixels
+    finally:
+        image.close()
+
+def _boxes(points, faces, margin):
+    """Get the (x0, y0, x1, y1) bounding boxes of faces or paths"""
+    if not len(faces):
+        return np.empty((0, 4), dtype=points.dtype)
+    face_points = points[faces.indices]
+    starts = faces.offsets[:-1]
+    return np.hstack((
+        np.minimum.reduceat(face_points, starts) - margin,
+        np.maximum.reduceat(face_points, starts) + margin,
+    ))
+
+def _overlaps(boxes, tile_boxes):
+    return (
+        (boxes[None, :, 0] < tile_boxes[:, None, 2])
+        & (boxes[None, :, 2] > tile_boxes[:, None, 0])
+        & (boxes[None, :, 1] < tile_boxes[:, None, 3])
+        & (boxes[None, :, 3] > tile_boxes[:, None, 1])
+    )
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--kind', default='cylinder', choices=list(models.SHAPES)
+    )
+    parser.add_argument('--segments', type=int, default=64)
+    parser.add_argument(
+        '--color', default='#000080', help='any CSS color, like #000080'
+    )
+    parser.add_argument('--width', type=int, default=8192)
+    parser.add_argument('--height', type=int, default=8192)
+    parser.add_argument('--x-rotation', type=float, default=pi / 4.5)
+    parser.add_argument('--z-rotation', type=float, default=pi / 8)
+    parser.add_argument('--tile-size', type=int, default=TILE_SIZE)
+    parser.add_argument(
+        '--workers', type=int, help='processes to use, default is all cores'
+    )
+    parser.add_argument('output', help='PNG file to write')
+    args = parser.parse_args(argv)
+
+    base_color = color(args.color)
+    with render_tiled(
+        models.SHAPES[args.kind](args.segments),
+        (base_color.r, base_color.g, base_color.b),
+        args.width, args.height, args.x_rotation, args.z_rotation,
+        args.tile_size, args.workers,
+    ) as pixels:
+        raster.write_png(args.output, pixels)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,6 +4,7 @@ Some fixes to the Toga framework - most should get contributed upstream
 import toga
 from toga.handlers import wrapped_handler
 from . import toga_gtk_fixes
+from .profiler import NULL_PROFILER
 
 
 class Canvas(toga.Canvas):
@@ -22,6 +23,16 @@ class Canvas(toga.Canvas):
         self._on_resize = wrapped_handler(self, handler)
         self._impl.set_on_resize(self._on_resize)
 
+    def set_frame(self, frame, profiler=NULL_PROFILER):
+        """Draw a renderer `Frame` below the drawing objects of the canvas
+
+        The frame arrays are drawn directly by the implementation, bypassing
+        the drawing object tree, timing the drawing stages into `profiler`.
+        Set to None to stop drawing it.
+        """
+        self._impl.set_frame(frame, profiler)
+        self.redraw()
+
     async def draw_done(self):
         await self._impl.draw_done()
 
@@ -1,10 +1,14 @@
 """
 Some fixes to the toga_gtk framework - most should get contributed upstream
 """
-from toga_gtk.libs import Gtk, Gdk
+from toga.widgets import canvas as toga_canvas
+from toga_gtk.libs import Gtk, Gdk, cairo
 import toga_gtk.factory
 from toga_gtk.factory import not_implemented
 
+from .renderer import BACKGROUND_COLOR, LINE_COLOR, frame_layers
+from .profiler import NULL_PROFILER
+
 class Canvas(toga_gtk.factory.Canvas):
     def create(self):
         super().create()
@@ -12,8 +16,15 @@ class Canvas(toga_gtk.factory.Canvas):
         self.__old_width = None
         self.__old_height = None
         self.__is_drawing = False
+        # Frames are rendered into an offscreen surface that is only redrawn
+        # when something new was drawn, other expose events just blit it
+        self.__surface = None
+        self.__dirty = True
+        self.frame = None
+        self.frame_profiler = NULL_PROFILER
 
     def redraw(self):
+        self.__dirty = True
         self.native.queue_draw()
 
     def gtk_draw_callback(self, canvas, gtk_context):
@@ -31,11 +42,143 @@ class Canvas(toga_gtk.factory.Canvas):
                     self.__is_drawing = False
             self.__old_width = new_width
             self.__old_height = new_height
-        super().gtk_draw_callback(canvas, gtk_context)
+            self.__surface = None
+        scale = self.native.get_scale_factor()
+        if (
+            self.__surface is None \
+            or self.__surface.get_device_scale() != (scale, scale)
+        ):
+            self.__surface = cairo.ImageSurface(
+                cairo.FORMAT_ARGB32, new_width * scale, new_height * scale
+            )
+            self.__surface.set_device_scale(scale, scale)
+            self.__dirty = True
+        if self.__dirty:
+            self.__dirty = False
+            self.draw_surface(self.__surface)
+        gtk_context.set_source_surface(self.__surface, 0, 0)
+        gtk_context.paint()
         for future in self.draw_done_futures:
             future.set_result(True)
         self.draw_done_futures = []
 
+    def draw_surface(self, surface):
+        context = cairo.Context(surface)
+        context.set_operator(cairo.OPERATOR_CLEAR)
+        context.paint()
+        context.set_operator(cairo.OPERATOR_OVER)
+        if self.frame is not None:
+            self.draw_frame(self.frame, context, self.frame_profiler)
+        self.replay(self.interface.drawing_objects, context)
+        surface.flush()
+
+    def set_frame(self, frame, profiler=NULL_PROFILER):
+        self.frame = frame
+        self.frame_profiler = profiler
+
+    def draw_frame(self, frame, context, profiler=NULL_PROFILER):
+        """Draw a renderer `Frame` straight from its arrays into Cairo
+
+        The coordinates are converted to lists in bulk, and runs of
+        consecutive faces that have the same color are filled together.
+        Outlines are stroked with round caps and joins, so the single edge
+        paths of scene frames join up like whole loops.
+        """
+        context.set_source_rgb(*(c / 255 for c in BACKGROUND_COLOR))
+        context.paint()
+        context.set_line_width(frame.line_width)
+        context.set_line_cap(cairo.LINE_CAP_ROUND)
+        context.set_line_join(cairo.LINE_JOIN_ROUND)
+        for faces, colors, paths in frame_layers(frame):
+            with profiler.stage('face_draw'):
+                self._draw_faces(frame.points, faces, colors, context)
+            with profiler.stage('edge_draw'):
+                self._draw_paths(frame.points, paths, context)
+
+    def _draw_faces(self, points, faces, colors, context):
+        move_to, line_to = context.move_to, context.line_to
+        close_path = context.close_path
+        points = points[faces.indices].tolist()
+        offsets = faces.offsets.tolist()
+        colors = (colors / 255.).tolist()
+        context.set_fill_rule(cairo.FILL_RULE_WINDING)
+        run_color = None
+        for start, end, color in zip(offsets[:-1], offsets[1:], colors):
+            if color != run_color:
+                if run_color is not None:
+                    context.set_source_rgb(*run_color)
+                    context.fill()
+                run_color = color
+            move_to(*points[start])
+            for x, y in points[start + 1:end]:
+                line_to(x, y)
+            close_path()
+        if run_color is not None:
+            context.set_source_rgb(*run_color)
+            context.fill()
+
+    def _draw_paths(self, points, paths, context):
+        if not paths:
+            return
+        move_to, line_to = context.move_to, context.line_to
+        close_path = context.close_path
+        indices = paths.indices.tolist()
+        points = points[paths.indices].tolist()
+        offsets = paths.offsets.tolist()
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            move_to(*points[start])
+            if indices[start] == indices[end - 1]:
+                for x, y in points[start + 1:end - 1]:
+                    line_to(x, y)
+                close_path()
+            else:
+                for x, y in points[start + 1:end]:
+                    line_to(x, y)
+        context.set_source_rgb(*(c / 255 for c in LINE_COLOR))
+        context.stroke()
+
+    def replay(self, drawing_objects, context):
+        """Draw Toga drawing objects straight into a Cairo context
+
+        The objects shapes draws frames with are handled here directly rather
+        than through each object dispatching back to the matching
+        implementation method, other objects fall back to that.
+        """
+        for obj in drawing_objects:
+            kind = type(obj)
+            if kind is toga_canvas.LineTo:
+                context.line_to(obj.x, obj.y)
+            elif kind is toga_canvas.ClosedPath:
+                context.move_to(obj.x, obj.y)
+                self.replay(obj.drawing_objects, context)
+                context.close_path()
+            elif kind is toga_canvas.MoveTo:
+                context.move_to(obj.x, obj.y)
+            elif kind is toga_canvas.Fill:
+                context.new_path()
+                self.replay(obj.drawing_objects, context)
+                self.apply_color(obj.color, context)
+                context.set_fill_rule(
+                    cairo.FILL_RULE_EVEN_ODD if obj.fill_rule == 'evenodd'
+                    else cairo.FILL_RULE_WINDING
+                )
+                if obj.preserve:
+                    context.fill_preserve()
+                else:
+                    context.fill()
+            elif kind is toga_canvas.Stroke:
+                self.replay(obj.drawing_objects, context)
+                self.apply_color(obj.color, context)
+                context.set_line_width(obj.line_width)
+                if obj.line_dash is not None:
+                    context.set_dash(obj.line_dash)
+                context.stroke()
+                context.set_dash([])
+            elif kind is toga_canvas.Rect:
+                context.rectangle(obj.x, obj.y, obj.width, obj.height)
+            else:
+                obj._draw(self, draw_context=context)
+
     def set_on_resize(self, handler):
         pass
 
@@ -43,6 +43,19 @@ def rotate_z(d):
         [     0.,     0., 0., 1.],
     ], dtype=np.float32)
 
+def projection(d=1):
+    """Perspective projection matrix
+
+    Projects along the Y axis, X and Z coordinates need to be divided by the
+    resulting W coordinate after transforming.
+    """
+    return np.array([
+        [d,  0., 0., 0.],
+        [0., 1., 0., 1.],
+        [0., 0., d,  0.],
+        [0., 0., 0., 0.],
+    ], dtype=np.float32)
+
 def perspective(vertices, d=1):
     dy = d / np.delete(vertices, (0, 2, 3), 1)
     ones = np.ones_like(dy)
@@ -50,31 +63,106 @@ def perspective(vertices, d=1):
     return vertices * tmat
 
 def normals(vertices, faces):
-    columns = [
-        [face[column] for face in faces]
-        for column in range(3)
-    ]
-    e1 = vertices[columns[1], 0:3] - vertices[columns[0], 0:3]
-    e2 = vertices[columns[2], 0:3] - vertices[columns[1], 0:3]
-    return np.cross(e1, e2)
-
-def backface_culling(faces, normals, face_indices, backface_indices=None, *args):
-    if backface_indices is None:
-        backface_indices = np.array([], dtype=int)
-    backfaces = normals[:,1] < 0
-    return (
-        faces[backfaces],
-        normals[backfaces],
-        face_indices[backfaces],
-        np.append(backface_indices, face_indices[np.logical_not(backfaces)]),
-        *(arg[backfaces] for arg in args)
-    )
-
-def backface_edge_culling(edges, backface_indices):
-    if len(edges) <= 0:
-        return edges
-    backface_edges = np.logical_not(np.logical_and(
-        np.in1d(edges[:,2], backface_indices),
-        np.in1d(edges[:,3], backface_indices)
-    ))
-    return edges[backface_edges]
+    v0, v1, v2 = (vertices[faces.column(n), 0:3] for n in range(3))
+    return np.cross(v1 - v0, v2 - v1)
+
+def face_centroids(vertices, faces):
+    """Get the average of the vertices of every face"""
+    sums = np.add.reduceat(vertices[faces.indices], faces.offsets[:-1])
+    return sums / faces.sizes[:, None].astype(vertices.dtype)
+
+def visible_faces(normals, face_points, out=None):
+    """Get a mask of the faces facing a camera sitting at the origin
+
+    `face_points` can be any point on each face, like its centroid, in the
+    same space as the `normals`. Since the test is done in view space before
+    projecting, it holds for faces seen at an angle under perspective too.
+    """
+    facing = np.einsum('ij,ij->i', normals, face_points[:, :3])
+    return np.less(facing, 0, out=out)
+
+def silhouette_edges(edges, visible, out=None):
+    """Get a mask of the edges between a visible face and a hidden one
+
+    `visible` is a face visibility mask, looked up by the face indices in the
+    edges table.
+    """
+    return np.not_equal(visible[edges[:, 2]], visible[edges[:, 3]], out=out)
+
+
+class Arena:
+    """Named scratch arrays reused from frame to frame
+
+    An array is only reallocated when a larger one than before is asked for
+    (or one of a different dtype or row shape), smaller requests get a view
+    of the start of it. `allocations` counts the reallocations, so a steady
+    state animation can be checked not to make any.
+    """
+    def __init__(self):
+        self.allocations = 0
+        self._arrays = dict()
+
+    def __iter__(self):
+        return iter(self._arrays.items())
+
+    def get(self, name, shape, dtype=np.float32):
+        shape = tuple(shape)
+        array = self._arrays.get(name)
+        if (
+            array is None or array.dtype != dtype \
+            or array.shape[1:] != shape[1:] or len(array) < shape[0]
+        ):
+            array = np.empty(shape, dtype=dtype)
+            self._arrays[name] = array
+            self.allocations += 1
+        return array[:shape[0]]
+
+
+class Pipeline:
+    """Shape to screen transform pipeline
+
+    Composes the shape rotation, the distance from the camera, the
+    perspective projection and the viewport transform into a single cached
+    matrix, which is only rebuilt when the camera parameters change.
+    """
+    def __init__(self, distance=5., focal_length=2.):
+        self.distance = distance
+        self.focal_length = focal_length
+        self._params = None
+        self.arena = Arena()
+
+    def update(
+        self, x_rotation, z_rotation, width, height, x_offset=0, y_offset=0
+    ):
+        """Set the camera parameters
+
+        `x_offset` and `y_offset` shift the viewport, to render a part of a
+        larger image that starts at that position.
+        """
+        params = (x_rotation, z_rotation, width, height, x_offset, y_offset)
+        if params == self._params:
+            return
+        self._params = params
+        self.width = width
+        self.height = height
+        self.rotation = rotate_z(z_rotation) @ rotate_x(x_rotation)
+        self.world = self.rotation @ move(0, self.distance)
+        self.screen = projection(self.focal_length) \
+            @ scale(width/2, width/2, -width/2) \
+            @ move(width/2 - x_offset, 0, height/2 - y_offset)
+        self.transform = self.world @ self.screen
+
+    def project(self, vertices, out=None):
+        """Transform vertices to screen space
+
+        Screen X and Y are in columns 0 and 2 of the returned array. Unless
+        given as `out`, the array is reused by the next call.
+        """
+        screen = out
+        if screen is None:
+            screen = self.arena.get('screen', (len(vertices), 4))
+        np.matmul(vertices, self.transform, out=screen)
+        np.divide(screen[:, :3], screen[:, 3:], out=screen[:, :3])
+        screen[:, 3] = 1.
+        return screen
+
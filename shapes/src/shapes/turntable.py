@@ -0,0 +1,120 @@
+"""turntable.py - render turntable image sequences of shapes without a window
+
+Run with `python -m shapes.turntable`. The frames of a full turn of a shape
+around its axis are spread over a pool of processes, each rendering frames
+with the software rasterizer and writing them out as PNG files as it goes.
+"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from math import pi
+from pathlib import Path
+import argparse
+import sys
+from travertino.colors import color, rgb
+
+from . import transforms as tr
+from . import models
+from . import renderer
+from . import raster
+
+X_ROTATION = pi / 4.5
+Z_ROTATION = pi / 8
+
+
+class Turntable:
+    """Renders the frames of a turntable sequence, one process each"""
+    def __init__(
+        self, kind, segments, base_color, width, height, frames, output,
+        x_rotation=X_ROTATION,
+    ):
+        self.shape = models.SHAPES[kind](segments)
+        self.base_color = rgb(*base_color)
+        self.width = width
+        self.height = height
+        self.frames = frames
+        self.path_format = str(
+            Path(output) / '{}-{}-{{:04d}}.png'.format(kind, segments)
+        )
+        self.x_rotation = x_rotation
+        self.pipeline = tr.Pipeline()
+        self.arena = tr.Arena()
+        self.framebuffer = raster.Framebuffer(width, height)
+
+    def render(self, i):
+        """Render frame `i` to its PNG file, and return the file path"""
+        z_rotation = (Z_ROTATION + 2 * pi * i / self.frames) % (2 * pi)
+        self.pipeline.update(
+            self.x_rotation, z_rotation, self.width, self.height
+        )
+        frame = renderer.prepare_frame(
+            self.shape, self.pipeline, self.base_color, arena=self.arena
+        )
+        self.framebuffer.draw(frame)
+        path = self.path_format.format(i)
+        raster.write_png(path, self.framebuffer.pixels)
+        return path
+
+# The turntable of a worker process
+_turntable = None
+
+def _init_worker(*args):
+    global _turntable
+    _turntable = Turntable(*args)
+
+def _render_frame(i):
+    return _turntable.render(i)
+
+def render_turntable(
+    kind, segments, base_color, width, height, frames, output,
+    x_rotation=X_ROTATION, workers=None,
+):
+    """Render a turntable sequence over a process pool
+
+    `base_color` is an (r, g, b) tuple. Yields the paths of the written
+    frames as they get done, which is not necessarily in order.
+    """
+    Path(output).mkdir(parents=True, exist_ok=True)
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker, initargs=(
+            kind, segments, tuple(base_color), width, height, frames,
+            output, x_rotation,
+        )
+    ) as executor:
+        futures = [executor.submit(_render_frame, i) for i in range(frames)]
+        for future in as_completed(futures):
+            yield future.result()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--kind', default='cylinder', choices=list(models.SHAPES)
+    )
+    parser.add_argument('--segments', type=int, default=32)
+    parser.add_argument(
+        '--color', default='#000080', help='any CSS color, like #000080'
+    )
+    parser.add_argument('--width', type=int, default=400)
+    parser.add_argument('--height', type=int, default=400)
+    parser.add_argument('--frames', type=int, default=72)
+    parser.add_argument(
+        '--tilt', type=float, default=X_ROTATION,
+        help='rotation around the X axis, in radians'
+    )
+    parser.add_argument('--output', default='.', help='directory to write to')
+    parser.add_argument(
+        '--workers', type=int, help='processes to use, default is all cores'
+    )
+    args = parser.parse_args(argv)
+
+    base_color = color(args.color)
+    written = 0
+    for path in render_turntable(
+        args.kind, args.segments, (base_color.r, base_color.g, base_color.b),
+        args.width, args.height, args.frames, args.output, args.tilt,
+        args.workers,
+    ):
+        written += 1
+        print('[{}/{}] {}'.format(written, args.frames, path))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,48 @@
+"""worker.py - frame preparation on a background thread
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from . import transforms as tr
+
+class FrameWorker:
+    """Prepare frames on a background thread
+
+    NumPy releases the GIL for the bulk of the work, so the next frame can be
+    prepared while the main loop presents the last one. `prepare` is called
+    with a `tr.Pipeline` and a `tr.Arena` followed by the arguments frames
+    are requested with, and must return a `Frame`.
+
+    Frames are prepared one at a time, each with the next of a ring of
+    `slots` pipelines and arenas, so the arrays of a frame stay intact until
+    `slots - 1` more frames were prepared after it. The frame arrays are made
+    read-only before being handed over.
+    """
+    def __init__(self, prepare, slots=3):
+        self._prepare = prepare
+        self._slots = [(tr.Pipeline(), tr.Arena()) for _ in range(slots)]
+        self._next_slot = 0
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='frame-worker'
+        )
+
+    def submit(self, loop, *args):
+        """Prepare a frame in the background, returning an asyncio future"""
+        return loop.run_in_executor(self._executor, self._run, *args)
+
+    def prepare(self, *args):
+        """Prepare a frame right away
+
+        Frames already submitted get prepared first.
+        """
+        return self._executor.submit(self._run, *args).result()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+    def _run(self, *args):
+        pipeline, arena = self._slots[self._next_slot]
+        self._next_slot = (self._next_slot + 1) % len(self._slots)
+        frame = self._prepare(pipeline, arena, *args)
+        frame.points.setflags(write=False)
+        frame.colors.setflags(write=False)
+        return frame
@@ -0,0 +1,105 @@
+"""test_frames.py - dtype and allocation checks of the frame pipeline
+"""
+from math import pi
+import tracemalloc
+import numpy as np
+import pytest
+from travertino.colors import rgb
+
+from shapes import models, renderer, transforms as tr
+from shapes.scene import Scene
+
+WIDTH = HEIGHT = 400
+COLOR = rgb(0, 0, 128)
+FRAMES = 20
+KINDS = sorted(models.SHAPES)
+# Steady state frames may allocate temporaries of up to this many times the
+# size of the frame they return, plus a fixed amount for small bookkeeping
+ALLOCATION_FACTOR = 24
+ALLOCATION_SLACK = 16 * 1024
+
+
+@pytest.mark.parametrize('in_scene', [False, True])
+@pytest.mark.parametrize('segments', [3, 16, 64])
+@pytest.mark.parametrize('kind', KINDS)
+def test_no_float64(kind, segments, in_scene):
+    shape = models.SHAPES[kind](segments)
+    assert _float64_arrays(shape._asdict().items()) == []
+    pipeline, arena = tr.Pipeline(), tr.Arena()
+    draw = _preparer(shape, in_scene)
+    for frame in _frames(draw, pipeline, arena):
+        assert _float64_arrays(_frame_arrays(frame)) == []
+    assert _float64_arrays(arena) == []
+    assert _float64_arrays(pipeline.arena) == []
+
+@pytest.mark.parametrize('in_scene', [False, True])
+@pytest.mark.parametrize('segments', [16, 256])
+@pytest.mark.parametrize('kind', KINDS)
+def test_steady_state_allocations(kind, segments, in_scene):
+    shape = models.SHAPES[kind](segments)
+    pipeline, arena = tr.Pipeline(), tr.Arena()
+    draw = _preparer(shape, in_scene)
+    # A first turn to fill the arena
+    for _ in _frames(draw, pipeline, arena):
+        pass
+    allocations = arena.allocations
+
+    tracemalloc.start()
+    try:
+        for i in range(FRAMES):
+            _turn(pipeline, i)
+            tracemalloc.reset_peak()
+            start, _ = tracemalloc.get_traced_memory()
+            frame = draw(pipeline, arena)
+            _, peak = tracemalloc.get_traced_memory()
+            frame_bytes = sum(a.nbytes for _, a in _frame_arrays(frame))
+            assert peak - start <= \
+                ALLOCATION_FACTOR * frame_bytes + ALLOCATION_SLACK
+            del frame
+    finally:
+        tracemalloc.stop()
+    assert arena.allocations == allocations
+
+
+def _preparer(shape, in_scene):
+    """Get a function preparing frames of a shape alone, or in a scene
+
+    The scene has the shape on its own and as a couple of instances, so it
+    is drawn in two batches.
+    """
+    if not in_scene:
+        return lambda pipeline, arena: renderer.prepare_frame(
+            shape, pipeline, COLOR, arena=arena
+        )
+    scene = Scene()
+    scene.add(shape, COLOR)
+    scene.add_instances(shape, [
+        tr.scale(0.3, 0.3, 0.3) @ tr.move(x, 0., 0.) for x in (-1., 1.)
+    ], [COLOR] * 2)
+    return lambda pipeline, arena: renderer.prepare_scene(
+        scene, pipeline, arena=arena
+    )
+
+def _frames(draw, pipeline, arena):
+    """Prepare a whole turn of frames"""
+    for i in range(FRAMES):
+        _turn(pipeline, i)
+        yield draw(pipeline, arena)
+
+def _turn(pipeline, i):
+    angle = 2 * pi * i / FRAMES
+    pipeline.update(angle, angle / 3, WIDTH, HEIGHT)
+
+def _frame_arrays(frame):
+    return [
+        ('points', frame.points), ('colors', frame.colors),
+        ('faces', frame.faces.indices), ('face_offsets', frame.faces.offsets),
+        ('paths', frame.paths.indices), ('path_offsets', frame.paths.offsets),
+        ('path_positions', frame.path_positions),
+    ]
+
+def _float64_arrays(arrays):
+    return sorted(
+        str(name) for name, a in arrays
+        if isinstance(a, np.ndarray) and a.dtype == np.float64
+    )